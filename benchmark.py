@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+# Benchmarks of pipeline overheads.
+#
+# Usage: ./benchmark.py initscript <initscript> [n_groups]
+#        ./benchmark.py imaging <parset> <ms> <output> [instances] [threads]
+#        ./benchmark.py suite <results> [stations] [subbands] [timesteps] [beams]
+#
+# `initscript` compares the time spent reading the environment from
+# <initscript> for every awimager invocation in a work unit of n_groups
+# (default 24) band groups, with and without caching.
+#
+# `imaging` makes the final image of the sample band group <ms> (normally a
+# limited-baseline MS), using the image.* and awimager.initscript settings in
+# the pipeline <parset>, with K simultaneous awimager instances of T threads
+# each, for every K in the comma-separated list `instances` (default
+# 1,2,3,4,6) and T in `threads` (default: the node's CPUs divided by K). Each
+# instance is bound to its own CPUs. The configuration which produces images
+# fastest is written, with all the timings, to the JSON file <output>, which
+# imaging-multibeam.py reads if it is named by imaging.config.
+#
+# `suite` needs neither LOFAR data nor the LOFAR tools: it generates a
+# synthetic work unit with synthetic.py, times the main pipeline functions on
+# it, and then runs imaging-multibeam.py over the whole work unit with stub
+# executables. The timings are appended, with the version of the code, to the
+# JSON lines file <results>. Any which are slower than the previous result for
+# the same work unit by more than REGRESSION_TOLERANCE are flagged as
+# regressions, and the exit status is then non-zero.
+
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+import lofar.parameterset
+from tempfile import mkdtemp
+
+import utility
+import resources
+import synthetic
+from msss_mask import fill_mask
+from sourcelist import load_skymodel
+from pyrap.tables import table
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# awimager is run with the initscript by the noise, mask and image stages.
+AWIMAGER_CALLS_PER_GROUP = 3
+
+# Number of times each function is timed by `suite`; the fastest is kept.
+SUITE_REPEATS = 3
+
+# A timing is a regression if it is more than REGRESSION_TOLERANCE (as a
+# fraction) and REGRESSION_MIN_TIME seconds slower than the previous result.
+REGRESSION_TOLERANCE = 0.2
+REGRESSION_MIN_TIME = 0.05
+
+
+def benchmark_initscript(initscript, n_groups=24):
+    calls = n_groups * AWIMAGER_CALLS_PER_GROUP
+
+    start_time = time.time()
+    for i in range(calls):
+        utility.source_initscript(initscript)
+    uncached = time.time() - start_time
+
+    utility._initscript_cache.clear()
+    start_time = time.time()
+    for i in range(calls):
+        utility.read_initscript(initscript)
+    cached = time.time() - start_time
+
+    print "%d calls (%d groups)" % (calls, n_groups)
+    print "Uncached: %f seconds (%f per call)" % (uncached, uncached / calls)
+    print "Cached:   %f seconds (%f per call)" % (cached, cached / calls)
+    print "Saving:   %f seconds" % (uncached - cached,)
+
+
+def time_imaging(parset_name, ms, wmax, instances, threads, initscript, scratchdir):
+    """
+    Return the wall clock time taken to make `instances` images of `ms`
+    simultaneously, each bound to `threads` CPUs.
+    """
+    resources.manager = resources.ResourceManager(
+        footprints={"awimager": {"cpus": threads, "pin": 1}}
+    )
+    images = [mkdtemp(dir=scratchdir) for i in range(instances)]
+    errors = []
+    def make_image(image):
+        try:
+            utility.run_awimager(parset_name,
+                {"ms": ms, "image": image, "threshold": "0Jy", "wmax": wmax},
+                initscript=initscript
+            )
+        except Exception, e:
+            errors.append(e)
+    workers = [
+        threading.Thread(target=make_image, args=(image,)) for image in images
+    ]
+    start_time = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall_time = time.time() - start_time
+    for image in images:
+        shutil.rmtree(image, ignore_errors=True)
+    if errors:
+        raise errors[0]
+    return wall_time
+
+
+def benchmark_imaging(parset_name, ms, output, instances=(1, 2, 3, 4, 6), threads=None):
+    input_parset = lofar.parameterset.parameterset(parset_name)
+    initscript = input_parset.getString("awimager.initscript", "") or None
+    scratchdir = mkdtemp(dir=os.getenv("TMPDIR"))
+    cpus = resources.ResourceManager().cpus
+    try:
+        image_parset = utility.get_parset_subset(input_parset, "image.parset", scratchdir)
+        trials = []
+        for k in instances:
+            for t in threads or [cpus // k]:
+                if not t or k * t > cpus:
+                    continue
+                wall_time = time_imaging(
+                    image_parset, ms, input_parset.getFloat("limit.max_baseline"),
+                    k, t, initscript, scratchdir
+                )
+                trials.append({
+                    "instances": k, "threads": t, "wall_time": wall_time,
+                    "images_per_hour": 3600. * k / wall_time
+                })
+                print "%d instance(s) x %d thread(s): %f seconds, %.2f images/hour" % (
+                    k, t, wall_time, trials[-1]["images_per_hour"]
+                )
+    finally:
+        shutil.rmtree(scratchdir, ignore_errors=True)
+    best = max(trials, key=lambda trial: trial["images_per_hour"])
+    print "Best: %d instance(s) x %d thread(s)" % (best["instances"], best["threads"])
+    with open(output, "w") as f:
+        json.dump({
+            "instances": best["instances"], "threads": best["threads"],
+            "cpus": cpus, "ms": ms, "trials": trials
+        }, f, indent=4, sort_keys=True)
+
+
+def best_time(function, setup=lambda: (), repeats=SUITE_REPEATS):
+    """
+    Return the shortest wall clock time taken by `function` in `repeats`
+    calls, each with fresh arguments returned by `setup`, which isn't timed.
+    """
+    times = []
+    for i in range(repeats):
+        args = setup()
+        start_time = time.time()
+        function(*args)
+        times.append(time.time() - start_time)
+    return min(times)
+
+
+def time_functions(unit, scratchdir):
+    """
+    Time the main pipeline functions on the synthetic work unit `unit`.
+    """
+    parset = lofar.parameterset.parameterset(unit["parset"])
+    ms = unit["target"][0]
+    maxbl = parset.getFloat("limit.max_baseline")
+    bad_station = table("%s::ANTENNA" % (ms,)).getcol("NAME")[0]
+    sources = load_skymodel(unit["skymodels"][0])
+    new_ms = lambda: (os.path.join(mkdtemp(dir=scratchdir), "output.MS"),)
+    noise_parset = utility.get_parset_subset(parset, "noise.parset", scratchdir)
+
+    timings = {}
+    timings["read_ms_list"] = best_time(
+        lambda: utility.read_ms_list(parset.getString("target_ms_list"))
+    )
+    timings["copy_to_work_area"] = best_time(
+        lambda work_area: utility.copy_to_work_area(unit["target"], work_area),
+        lambda: (mkdtemp(dir=scratchdir),)
+    )
+    timings["detect_bad_stations"] = best_time(
+        lambda: utility.detect_bad_stations(ms)
+    )
+    timings["strip_stations"] = best_time(
+        lambda output: utility.strip_stations(ms, output, [bad_station]), new_ms
+    )
+    timings["limit_baselines"] = best_time(
+        lambda output: utility.limit_baselines(ms, output, maxbl), new_ms
+    )
+    timings["estimate_noise"] = best_time(
+        lambda: utility.estimate_noise(
+            ms, noise_parset, maxbl, parset.getInt("noise.box_size"), scratchdir,
+            awim_init=unit["initscript"]
+        )
+    )
+    timings["mask_template"] = best_time(
+        lambda mask: utility.mask_template(
+            mask, ms, parset.getInt("image.parset.npix"),
+            parset.getString("image.parset.cellsize"), "I"
+        ),
+        lambda: (os.path.join(mkdtemp(dir=scratchdir), "mask"),)
+    )
+    timings["fill_mask"] = best_time(
+        lambda mask: fill_mask(mask, sources),
+        lambda: (synthetic.make_image(
+            os.path.join(mkdtemp(dir=scratchdir), "mask"), ms,
+            parset.getInt("image.parset.npix"),
+            parset.getString("image.parset.cellsize"), "I"
+        ),)
+    )
+    return timings
+
+
+def time_pipeline(unit, scratchdir):
+    """
+    Run imaging-multibeam.py over the synthetic work unit `unit`, returning
+    the wall clock time it took.
+    """
+    env = dict(os.environ,
+        PATH="%s:%s" % (unit["bin"], os.environ.get("PATH", "")),
+        TMPDIR=mkdtemp(dir=scratchdir)
+    )
+    log_name = os.path.join(os.path.dirname(unit["parset"]), "pipeline.log")
+    with open(log_name, "w") as log:
+        start_time = time.time()
+        status = subprocess.call(
+            [sys.executable, os.path.join(SCRIPT_DIR, "imaging-multibeam.py"), unit["parset"]],
+            stdout=log, stderr=subprocess.STDOUT, env=env
+        )
+        wall_time = time.time() - start_time
+    if status:
+        with open(log_name, "r") as log:
+            print log.read()
+        raise subprocess.CalledProcessError(status, "imaging-multibeam.py")
+    return wall_time
+
+
+def code_version():
+    try:
+        return subprocess.Popen(
+            ["git", "describe", "--always", "--dirty"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=SCRIPT_DIR
+        ).communicate()[0].strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def previous_result(results, config):
+    """
+    Return the most recent result in the file `results` for the work unit
+    described by `config`, or None.
+    """
+    previous = None
+    if os.path.exists(results):
+        with open(results, "r") as f:
+            for line in f:
+                result = json.loads(line)
+                if result["config"] == config:
+                    previous = result
+    return previous
+
+
+def find_regressions(previous, timings):
+    return sorted(
+        name for name, wall_time in timings.iteritems()
+        if name in previous["timings"] and
+        wall_time > previous["timings"][name] * (1 + REGRESSION_TOLERANCE) and
+        wall_time - previous["timings"][name] > REGRESSION_MIN_TIME
+    )
+
+
+def benchmark_suite(results, stations=24, subbands=4, timesteps=30, beams=2):
+    config = {
+        "stations": stations, "subbands": subbands,
+        "timesteps": timesteps, "beams": beams,
+        "stub_runtimes": synthetic.STUB_RUNTIMES
+    }
+    directory = mkdtemp(dir=os.getenv("TMPDIR"))
+    try:
+        print "Generating synthetic work unit in %s" % (directory,)
+        unit = synthetic.make_work_unit(directory, stations, subbands, timesteps, beams)
+        scratchdir = os.path.join(directory, "scratch")
+        os.mkdir(scratchdir)
+        timings = time_functions(unit, scratchdir)
+        timings["imaging-multibeam.py"] = time_pipeline(unit, scratchdir)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    previous = previous_result(results, config)
+    regressions = find_regressions(previous, timings) if previous else []
+    if previous:
+        print "Compared with %s:" % (previous["version"],)
+    for name, wall_time in sorted(timings.iteritems()):
+        line = "%-22s %10.3f s" % (name, wall_time)
+        if previous and name in previous["timings"]:
+            before = previous["timings"][name]
+            line += " %10.3f s %+7.1f%%" % (before, 100. * (wall_time - before) / before)
+        if name in regressions:
+            line += "  REGRESSION"
+        print line
+    with open(results, "a") as f:
+        f.write(json.dumps({
+            "version": code_version(), "time": time.time(),
+            "config": config, "timings": timings
+        }, sort_keys=True) + "\n")
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "initscript":
+        benchmark_initscript(sys.argv[2], *[int(arg) for arg in sys.argv[3:]])
+    elif len(sys.argv) >= 5 and sys.argv[1] == "imaging":
+        benchmark_imaging(sys.argv[2], sys.argv[3], sys.argv[4], *[
+            [int(value) for value in arg.split(",")] for arg in sys.argv[5:7]
+        ])
+    elif 3 <= len(sys.argv) <= 7 and sys.argv[1] == "suite":
+        if benchmark_suite(sys.argv[2], *[int(arg) for arg in sys.argv[3:]]):
+            sys.exit(1)
+    else:
+        print "Usage: %s initscript <initscript> [n_groups]" % (sys.argv[0],)
+        print "       %s imaging <parset> <ms> <output> [instances] [threads]" % (sys.argv[0],)
+        print "       %s suite <results> [stations] [subbands] [timesteps] [beams]" % (sys.argv[0],)
+        sys.exit(1)
@@ -0,0 +1,207 @@
+import os
+import json
+import errno
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+import warnings
+from contextlib import contextmanager
+from tempfile import mkdtemp
+
+from utility import make_directory
+
+# Name of the file holding the description and size of each entry. Its
+# modification time records when the entry was last used.
+ENTRY_FILENAME = "entry.json"
+
+# fcntl locks are held by the process rather than the thread, so the threads
+# of a process are serialized by one of these for each lock file first.
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(lock_name):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(lock_name, threading.Lock())
+
+
+def file_hash(path):
+    """
+    SHA1 checksum of the contents of the file `path`.
+    """
+    checksum = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def tree_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def _copy(source, destination):
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copy2(source, destination)
+
+
+def _link(source, destination):
+    # Hard link the files of `source` to `destination`, copying them if they
+    # are on different filesystems.
+    if not os.path.isdir(source):
+        try:
+            os.link(source, destination)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(source, destination)
+        return
+    os.mkdir(destination)
+    for name in os.listdir(source):
+        _link(os.path.join(source, name), os.path.join(destination, name))
+
+
+class Cache(object):
+    """
+    A content-addressed cache of files and directory trees, which may be
+    shared by concurrent jobs on different nodes.
+
+    Each entry is identified by a key derived from a description of how its
+    contents were produced (see key()). The total size of the entries is
+    kept below `max_size` bytes, if given, by removing the least recently
+    used ones.
+
+    Entries are written atomically. lock() serializes the work of producing
+    an entry, so that concurrent jobs which need the same one wait for the
+    first to finish instead of producing it again.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        make_directory(directory)
+
+    def key(self, **description):
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Hold an exclusive lock on `key` for the duration of the context,
+        against other threads as well as other processes.
+        """
+        lock_name = os.path.abspath(self._path(key) + ".lock")
+        with _thread_lock(lock_name):
+            with open(lock_name, "a") as lockfile:
+                fcntl.lockf(lockfile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lockfile, fcntl.LOCK_UN)
+
+    def get(self, key, destination, link=False):
+        """
+        Copy the contents of entry `key` to `destination`, replacing anything
+        already there. Returns True on a hit, False on a miss.
+
+        With `link`, the files are hard linked rather than copied where
+        possible; they must then not be modified in place.
+        """
+        entry = self._path(key)
+        try:
+            # Mark the entry as used, so it isn't evicted
+            os.utime(os.path.join(entry, ENTRY_FILENAME), None)
+        except OSError:
+            return False
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        elif os.path.exists(destination):
+            os.unlink(destination)
+        (_link if link else _copy)(os.path.join(entry, "data"), destination)
+        return True
+
+    def put(self, key, source, **description):
+        """
+        Store a copy of `source` as entry `key`, recording `description`
+        alongside it.
+        """
+        temp_dir = mkdtemp(dir=self.directory, prefix=".")
+        try:
+            _copy(source, os.path.join(temp_dir, "data"))
+            with open(os.path.join(temp_dir, ENTRY_FILENAME), "w") as f:
+                json.dump(dict(
+                    description, size=tree_size(source), created=time.time()
+                ), f, indent=4, sort_keys=True)
+            os.chmod(temp_dir, 0755)
+            if os.path.exists(self._path(key)):
+                shutil.rmtree(self._path(key))
+            os.rename(temp_dir, self._path(key))
+        except:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """
+        Return a list of (key, description, last used) for every entry.
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            filename = os.path.join(self._path(key), ENTRY_FILENAME)
+            try:
+                with open(filename, "r") as f:
+                    description = json.load(f)
+                entries.append((key, description, os.path.getmtime(filename)))
+            except (IOError, OSError, ValueError):
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is no larger
+        than max_size. Entries which are locked, by this process or any
+        other, are left alone.
+        """
+        if not self.max_size:
+            return
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(description["size"] for key, description, used in entries)
+        for key, description, used in entries:
+            if total <= self.max_size:
+                break
+            lock_name = os.path.abspath(self._path(key) + ".lock")
+            thread_lock = _thread_lock(lock_name)
+            # Another of our threads holds the key: opening and closing its
+            # lock file here would release that thread's lock.
+            if not thread_lock.acquire(False):
+                continue
+            try:
+                with open(lock_name, "a") as lockfile:
+                    try:
+                        fcntl.lockf(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        continue
+                    try:
+                        # Rename first, so that the entry disappears atomically.
+                        doomed = mkdtemp(dir=self.directory, prefix=".")
+                        os.rename(self._path(key), os.path.join(doomed, key))
+                        shutil.rmtree(doomed)
+                        total -= description["size"]
+                    except OSError, e:
+                        warnings.warn("Unable to evict %s: %s" % (key, e))
+                    finally:
+                        fcntl.lockf(lockfile, fcntl.LOCK_UN)
+            finally:
+                thread_lock.release()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# Spread the processing of a work unit over several jobs.
+#
+# Usage: ./dispatch.py <parset> [backend] [n_jobs]
+#        ./dispatch.py check <parset>
+#
+# The calibrator is processed by one job. Once that has finished, the band
+# groups of the target are divided between n_jobs further jobs, each of which
+# may run on a different node. All jobs write to the usual output directory
+# layout, so the results are gathered in the same place as if the work unit
+# had been processed by a single job; a final job checks that every group has
+# been imaged.
+#
+# The backend is either "pbs" (submit the jobs to the batch queue with qsub)
+# or "local" (run them as processes on this node, which is useful for
+# testing). The defaults, and the settings for the jobs, are taken from the
+# dispatch.* keys in the parset:
+#
+# dispatch.backend      Default backend (pbs)
+# dispatch.jobs         Default number of group jobs (4)
+# dispatch.local.jobs   Simultaneous jobs run by the local backend (1)
+# dispatch.qsub         Command used to submit jobs (qsub)
+# dispatch.walltime     Walltime requested for each job (7:00:00)
+# dispatch.ppn          Processors per node requested for each job (8)
+# dispatch.initscripts  Scripts sourced before running each job
+# dispatch.python       Python interpreter used to run each job (python)
+
+import os
+import sys
+import subprocess
+import textwrap
+import lofar.parameterset
+
+from manifest import Manifest
+from scheduler import Scheduler
+from utility import group_names
+from utility import make_directory
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATE_JOB = """
+    #PBS -N %(name)s
+    #PBS -lwalltime=%(walltime)s
+    #PBS -lnodes=1:ppn=%(ppn)d
+    #PBS -S /bin/bash
+    #PBS -j oe
+    #PBS -o %(log)s
+    %(setup)s
+    cd %(directory)s
+    time %(command)s
+"""
+TEMPLATE_JOB = textwrap.dedent(TEMPLATE_JOB).strip()
+
+
+class LocalBackend(object):
+    """
+    Run jobs as processes on this node, `max_jobs` at a time, logging their
+    output to `directory`.
+    """
+    def __init__(self, directory, max_jobs=1):
+        self.directory = directory
+        self.scheduler = Scheduler(limits={"job": max_jobs})
+
+    def _run(self, name, command):
+        with open(os.path.join(self.directory, name + ".log"), "w") as log:
+            subprocess.check_call(
+                command, stdout=log, stderr=subprocess.STDOUT, cwd=self.directory
+            )
+
+    def submit(self, name, command, depends=()):
+        """
+        Run `command` once the jobs `depends` have succeeded. Returns a job
+        identifier.
+        """
+        return self.scheduler.add(name, self._run, name, command,
+            stage="job", depends=list(depends)
+        )
+
+    def wait(self):
+        self.scheduler.run()
+
+
+class PBSBackend(object):
+    """
+    Submit jobs to the batch queue, writing their scripts and logs to
+    `directory`.
+
+    The queue is only contacted through the `qsub` command, which must print
+    the identifier of each job it accepts, so it may be replaced by a local
+    stand-in.
+    """
+    def __init__(self, directory, qsub="qsub", walltime="7:00:00", ppn=8, initscripts=()):
+        self.directory = directory
+        self.qsub = qsub
+        self.walltime = walltime
+        self.ppn = ppn
+        self.initscripts = initscripts
+
+    def submit(self, name, command, depends=()):
+        script = os.path.join(self.directory, name + ".job")
+        with open(script, "w") as f:
+            f.write(TEMPLATE_JOB % {
+                "name": name,
+                "walltime": self.walltime,
+                "ppn": self.ppn,
+                "log": os.path.join(self.directory, name + ".log"),
+                "setup": "\n".join("source %s" % (s,) for s in self.initscripts),
+                "directory": self.directory,
+                "command": " ".join(command)
+            })
+        args = [self.qsub]
+        if depends:
+            args.extend(["-W", "depend=afterok:%s" % (":".join(depends),)])
+        args.append(script)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output, _ = p.communicate()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args)
+        job_id = output.strip()
+        print "Submitted %s as %s" % (name, job_id)
+        return job_id
+
+    def wait(self):
+        # The queue runs the jobs.
+        pass
+
+
+def make_backend(name, parset, directory):
+    if name == "local":
+        return LocalBackend(directory, parset.getInt("dispatch.local.jobs", 1))
+    elif name == "pbs":
+        initscripts = []
+        if parset.isDefined("dispatch.initscripts"):
+            initscripts = parset.getStringVector("dispatch.initscripts")
+        return PBSBackend(
+            directory,
+            qsub=parset.getString("dispatch.qsub", "qsub"),
+            walltime=parset.getString("dispatch.walltime", "7:00:00"),
+            ppn=parset.getInt("dispatch.ppn", 8),
+            initscripts=initscripts
+        )
+    raise ValueError("Unknown backend %s" % (name,))
+
+
+def split_groups(names, n_jobs):
+    """
+    Divide `names` into at most `n_jobs` contiguous, nearly equal, lists.
+    """
+    n_jobs = max(1, min(n_jobs, len(names)))
+    size, extra = divmod(len(names), n_jobs)
+    chunks, start = [], 0
+    for i in range(n_jobs):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(names[start:end])
+        start = end
+    return chunks
+
+
+def target_directory(parset):
+    return os.path.join(
+        parset.getString("output_dir"), "target", parset.getString("target_obsid")
+    )
+
+
+def check(parset):
+    """
+    Return the names of the groups in the work unit which have not yet been
+    imaged.
+    """
+    manifest = Manifest(os.path.join(target_directory(parset), "manifest"))
+    return [
+        name for name in group_names(parset)
+        if not manifest.satisfied("image %s" % (name,))
+    ]
+
+
+def dispatch(parset_name, backend_name=None, n_jobs=None):
+    parset = lofar.parameterset.parameterset(parset_name)
+    parset_name = os.path.abspath(parset_name)
+    backend_name = backend_name or parset.getString("dispatch.backend", "pbs")
+    n_jobs = n_jobs or parset.getInt("dispatch.jobs", 4)
+    directory = os.path.join(target_directory(parset), "jobs")
+    make_directory(directory)
+    backend = make_backend(backend_name, parset, directory)
+
+    pipeline = [
+        parset.getString("dispatch.python", "python"),
+        os.path.join(SCRIPT_DIR, "imaging-multibeam.py")
+    ]
+    calibrator = backend.submit(
+        "calibrator", pipeline + ["--calibrator-only", parset_name]
+    )
+    jobs = [
+        backend.submit(
+            "groups%d" % (i,), pipeline + ["--groups", ",".join(chunk), parset_name],
+            depends=[calibrator]
+        )
+        for i, chunk in enumerate(split_groups(group_names(parset), n_jobs))
+    ]
+    backend.submit("check",
+        [pipeline[0], os.path.join(SCRIPT_DIR, "dispatch.py"), "check", parset_name],
+        depends=jobs
+    )
+    backend.wait()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "check":
+        missing = check(lofar.parameterset.parameterset(sys.argv[2]))
+        if missing:
+            print "Groups not yet imaged: %s" % (", ".join(missing),)
+            sys.exit(1)
+        print "All groups imaged"
+    elif 2 <= len(sys.argv) <= 4:
+        dispatch(sys.argv[1], *[
+            conversion(arg) for conversion, arg in zip((str, int), sys.argv[2:])
+        ])
+    else:
+        print "Usage: %s <parset> [local|pbs] [n_jobs]" % (sys.argv[0],)
+        print "       %s check <parset>" % (sys.argv[0],)
+        sys.exit(1)
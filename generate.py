@@ -5,6 +5,8 @@ import sys
 import textwrap
 import lofar.parameterset
 
+from cache import Cache
+from mscatalogue import Catalogue
 from utility import make_directory
 from utility import sorted_ms_list
 
@@ -22,6 +24,15 @@ INPUT_DIR = "/home/jswinban/test_run"
 OUTPUT_DIR = "/home/jswinban/test_run_output"
 SKYMODEL_DIR = "/home/jswinban/imaging/skymodels"
 
+# Calibration solutions shared between work units
+CALCACHE_DIR = "/home/jswinban/calcache"
+
+# Clean masks shared between work units
+MASKCACHE_DIR = "/home/jswinban/maskcache"
+
+# Metadata of the input MSs (see mscatalogue.py); None to read the MSs
+CATALOGUE = "/home/jswinban/ms_catalogue.sqlite"
+
 TEMPLATE_JOB = """
     #PBS -lwalltime=7:00:00
                              # 7 hours wall-clock
@@ -36,6 +47,22 @@ TEMPLATE_JOB = """
 """
 TEMPLATE_JOB = textwrap.dedent(TEMPLATE_JOB).strip()
 
+
+def input_ms_list(obsid, catalogue=None):
+    """
+    Return the MSs of `obsid` in INPUT_DIR, sorted by subband. With a
+    `catalogue`, only MSs which are new or have changed are read.
+    """
+    directory = os.path.join(INPUT_DIR, obsid)
+    if not catalogue:
+        return sorted_ms_list(directory)
+    catalogue.scan([directory])
+    return [
+        entry["path"] for entry in catalogue.query(directory)
+        if entry["path"].endswith("_uv.MS.dppp")
+    ]
+
+
 if __name__ == "__main__":
     target_obsid = sys.argv[1]
     cal_obsid = sys.argv[2]
@@ -45,17 +72,18 @@ if __name__ == "__main__":
     TARGET_OUTPUT = os.path.join(OUTPUT_DIR, "target", target_obsid)
     make_directory(CAL_OUTPUT)
     make_directory(TARGET_OUTPUT)
+    catalogue = Catalogue(CATALOGUE) if CATALOGUE else None
 
     # Check data exists: we should have sum(BAND_SIZE) subbands in each beam,
     # N_BEAMS beams per target_obsid, and 1 beam per cal_obsid.
     # We write the validated data to input files for the imaging pipeline.
-    ms_list = sorted_ms_list(os.path.join(INPUT_DIR, cal_obsid))[:sum(BAND_SIZE)]
+    ms_list = input_ms_list(cal_obsid, catalogue)[:sum(BAND_SIZE)]
     assert(len(ms_list) == sum(BAND_SIZE))
     with open(os.path.join(TARGET_OUTPUT, "cal_ms_list"), 'w') as f:
         for ms in ms_list:
             f.write("%s\n" % ms)
 
-    ms_list = sorted_ms_list(os.path.join(INPUT_DIR, target_obsid))[:sum(BAND_SIZE)*N_BEAMS]
+    ms_list = input_ms_list(target_obsid, catalogue)[:sum(BAND_SIZE)*N_BEAMS]
     assert(len(ms_list) == sum(BAND_SIZE) * N_BEAMS)
     with open(os.path.join(TARGET_OUTPUT, "target_ms_list"), 'w') as f:
         for ms in ms_list:
@@ -70,9 +98,21 @@ if __name__ == "__main__":
     parset.replace("band_size", str(BAND_SIZE))
     parset.replace("output_dir", OUTPUT_DIR)
     parset.replace("skymodel_dir", SKYMODEL_DIR)
+    parset.replace("calcache.directory", CALCACHE_DIR)
+    parset.replace("maskcache.directory", MASKCACHE_DIR)
+    if CATALOGUE:
+        parset.replace("catalogue", CATALOGUE)
     parset_filename = os.path.join(TARGET_OUTPUT, target_obsid + ".parset")
     parset.writeFile(parset_filename)
 
+    cached = set(
+        description["subband"] for key, description, used in Cache(CALCACHE_DIR).entries()
+        if description.get("cal_obsid") == cal_obsid
+    )
+    print "Cached solutions available for %d of %d subbands of %s" % (
+        len(cached), sum(BAND_SIZE), cal_obsid
+    )
+
     job = TEMPLATE_JOB % (TARGET_OUTPUT, parset_filename)
     with open(os.path.join(TARGET_OUTPUT, target_obsid + ".job"), "w") as jobfile:
         jobfile.write(job)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Noise statistics of casacore images, read a strip at a time.
+#
+# Usage: ./imagestats.py noise <image> <box_size> [estimator] [stokes]
+#        ./imagestats.py rms_map <image> <output> <box_size> [estimator]
+#
+# `noise` prints the noise in the central box (of half-width box_size pixels)
+# of the first frequency plane in the given Stokes parameter (default V).
+# `rms_map` writes an image in which each box_size square tile of every plane
+# of <image> is replaced by its noise.
+#
+# Estimators are std (the standard deviation), mad (the median absolute
+# deviation, scaled to sigma for Gaussian noise) and clipped (the standard
+# deviation after iterative sigma-clipping). All of them read the image in
+# strips of CHUNK_ROWS rows, so memory use doesn't depend on the image size;
+# mad and clipped make several passes. Non-finite pixels are ignored.
+
+import sys
+import numpy as np
+import pyrap.images as pi
+
+# Number of image rows read at a time
+CHUNK_ROWS = 256
+
+# Number of histogram bins used to locate a median in each pass, and number of
+# passes. The median is found to within (range / HISTOGRAM_BINS**MEDIAN_PASSES).
+HISTOGRAM_BINS = 1024
+MEDIAN_PASSES = 3
+
+# MAD of a Gaussian distribution, in units of its standard deviation
+MAD_TO_SIGMA = 1.4826
+
+# Sigma-clipping parameters
+CLIP_SIGMA = 3.
+CLIP_ITERATIONS = 10
+CLIP_TOLERANCE = 1e-3
+
+
+class RunningStats(object):
+    """
+    Mean and standard deviation of values added a chunk at a time.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, values):
+        n = values.size
+        if not n:
+            return
+        mean = values.mean(dtype=np.float64)
+        m2 = ((values - mean)**2).sum(dtype=np.float64)
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+
+    @property
+    def std(self):
+        if not self.n:
+            return np.nan
+        return np.sqrt(self.m2 / self.n)
+
+
+def _finite(source):
+    # Iterate over the finite values of each chunk produced by `source`.
+    for chunk in source():
+        chunk = np.asarray(chunk).ravel()
+        yield chunk[np.isfinite(chunk)]
+
+
+def running_stats(source, select=None):
+    stats = RunningStats()
+    for chunk in _finite(source):
+        if select:
+            chunk = chunk[select(chunk)]
+        stats.add(chunk)
+    return stats
+
+
+def streaming_median(source):
+    """
+    Median of the values produced by `source`, a callable returning an
+    iterator over chunks of values, without holding them all in memory.
+
+    The range containing the median is narrowed by histogramming the values
+    in MEDIAN_PASSES successive passes.
+    """
+    count, lo, hi = 0, np.inf, -np.inf
+    for chunk in _finite(source):
+        if chunk.size:
+            count += chunk.size
+            lo = min(lo, chunk.min())
+            hi = max(hi, chunk.max())
+    if not count:
+        return np.nan
+    rank = count // 2
+    below = 0
+    last_bin = True
+    for i in range(MEDIAN_PASSES):
+        if hi <= lo:
+            break
+        histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        for chunk in _finite(source):
+            if last_bin:
+                chunk = chunk[(chunk >= lo) & (chunk <= hi)]
+            else:
+                chunk = chunk[(chunk >= lo) & (chunk < hi)]
+            histogram += np.histogram(chunk, bins=HISTOGRAM_BINS, range=(lo, hi))[0]
+        edges = np.linspace(lo, hi, HISTOGRAM_BINS + 1)
+        cumulative = below + np.cumsum(histogram)
+        index = min(
+            np.searchsorted(cumulative, rank, side="right"), HISTOGRAM_BINS - 1
+        )
+        if index:
+            below = cumulative[index - 1]
+        last_bin = last_bin and index == HISTOGRAM_BINS - 1
+        lo, hi = edges[index], edges[index + 1]
+    return (lo + hi) / 2.
+
+
+def estimate_std(source):
+    return running_stats(source).std
+
+
+def estimate_mad(source):
+    median = streaming_median(source)
+    return MAD_TO_SIGMA * streaming_median(
+        lambda: (np.abs(chunk - median) for chunk in _finite(source))
+    )
+
+
+def estimate_clipped(source):
+    stats = running_stats(source)
+    mean, std = stats.mean, stats.std
+    for i in range(CLIP_ITERATIONS):
+        clipped = running_stats(
+            source, lambda chunk: np.abs(chunk - mean) <= CLIP_SIGMA * std
+        )
+        if not clipped.n:
+            break
+        converged = abs(clipped.std - std) <= CLIP_TOLERANCE * std
+        mean, std = clipped.mean, clipped.std
+        if converged:
+            break
+    return std
+
+
+ESTIMATORS = {
+    "std": estimate_std,
+    "mad": estimate_mad,
+    "clipped": estimate_clipped,
+}
+
+
+def read_strips(image, plane, blc, trc, chunk_rows=CHUNK_ROWS):
+    """
+    Iterate over the pixels of `image` in the box from `blc` to `trc`
+    (inclusive (y, x) pairs) of `plane` (the indices of the leading
+    axes), CHUNK_ROWS rows at a time.
+    """
+    plane = list(plane)
+    for y in range(blc[0], trc[0] + 1, chunk_rows):
+        yield image.getdata(
+            blc=plane + [y, blc[1]],
+            trc=plane + [min(y + chunk_rows - 1, trc[0]), trc[1]]
+        )
+
+
+def stokes_index(image, stokes):
+    return image.coordinates().get_coordinate("stokes").get_stokes().index(stokes)
+
+
+def box_noise(image_name, box_size, estimator="std", stokes="V"):
+    """
+    Noise in the central box of half-width `box_size` pixels in the first
+    frequency plane and given Stokes parameter of the image `image_name`.
+    Only that box is read.
+    """
+    box_size = int(box_size)
+    image = pi.image(image_name)
+    ny, nx = image.shape()[-2:]
+    blc = (ny // 2 - box_size, nx // 2 - box_size)
+    trc = (ny // 2 + box_size - 1, nx // 2 + box_size - 1)
+    plane = (0, stokes_index(image, stokes))
+    return ESTIMATORS[estimator](lambda: read_strips(image, plane, blc, trc))
+
+
+def rms_map(image_name, output_name, box_size, estimator="std"):
+    """
+    Write an image `output_name`, with the same shape and coordinates as
+    `image_name`, in which each `box_size` square tile of every plane holds
+    the noise in that tile. The input is read one row of tiles at a time.
+    """
+    estimate = ESTIMATORS[estimator]
+    image = pi.image(image_name)
+    shape = image.shape()
+    output = pi.image(output_name, shape=shape, coordsys=image.coordinates())
+    ny, nx = shape[-2:]
+    for plane in np.ndindex(*shape[:-2]):
+        for y in range(0, ny, box_size):
+            strip = image.getdata(
+                blc=list(plane) + [y, 0],
+                trc=list(plane) + [min(y + box_size, ny) - 1, nx - 1]
+            )
+            rms = np.empty(strip.shape, dtype=np.float32)
+            for x in range(0, nx, box_size):
+                tile = strip[..., x:x + box_size]
+                rms[..., x:x + box_size] = estimate(lambda: [tile])
+            output.putdata(rms, blc=list(plane) + [y, 0])
+    return output_name
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "noise":
+        print box_noise(sys.argv[2], int(sys.argv[3]), *sys.argv[4:])
+    elif len(sys.argv) >= 5 and sys.argv[1] == "rms_map":
+        rms_map(sys.argv[2], sys.argv[3], int(sys.argv[4]), *sys.argv[5:])
+    else:
+        print "Usage: %s noise <image> <box_size> [estimator] [stokes]" % (sys.argv[0],)
+        print "       %s rms_map <image> <output> <box_size> [estimator]" % (sys.argv[0],)
+        sys.exit(1)
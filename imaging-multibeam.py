@@ -2,61 +2,155 @@
 
 import os
 import sys
+import json
 import numpy
-import math
 import glob
 import shutil
 import lofar.parameterset
 
+from optparse import OptionParser
+from collections import OrderedDict
 from multiprocessing import cpu_count
-from multiprocessing.pool import ThreadPool
 
 from tempfile import mkdtemp
 
-from pyrap.tables import table
-
 from utility import run_process
 from utility import time_code
 from utility import get_parset_subset
+from utility import patch_parset
 from utility import make_directory
 from utility import copy_to_work_area
 
 from utility import run_awimager
 from utility import run_ndppp
 from utility import run_calibrate_standalone
-from utility import clear_calibrate_stand_alone_logs
 from utility import find_bad_stations
+from utility import detect_bad_stations
 from utility import strip_stations
 from utility import limit_baselines
 from utility import estimate_noise
+from utility import visibility_noise
 from utility import make_mask
 from utility import read_ms_list
+from utility import group_name
+from utility import RowLayout
+
+from mscatalogue import Catalogue
+from mscatalogue import pointing
+from mscatalogue import observation_target
+from mscatalogue import reference_frequency
+from scheduler import Scheduler
+from manifest import Manifest
+from cache import Cache
+from cache import file_hash
+from cache import tree_size
+from scratch import ScratchManager
+import staging
+import metrics
+import resources
+import supervisor
 
 # All temporary writes go to scratch space on the node.
 scratch = os.getenv("TMPDIR")
 
+# Default limits on the number of simultaneous tasks in each scheduler slot;
+# other slots default to the number of CPUs.
+DEFAULT_LIMITS = {
+    # Parallel copies from shared storage
+    "copy": 4,
+    # Most Lisa nodes have 24 GB RAM -- we don't want to run out
+    "phaseonly": 6,
+    # The noise, mask and image stages all run awimager, which is
+    # parallelized, so we run one at a time.
+    "awimager": 1,
+}
+
 if __name__ == "__main__":
-    # Our single command line argument is a parset containing all
-    # configuration information we'll need.
-    input_parset = lofar.parameterset.parameterset(sys.argv[1])
+    # Our command line argument is a parset containing all configuration
+    # information we'll need. By default, the whole work unit is processed;
+    # dispatch.py spreads it over several jobs by selecting either the
+    # calibrator alone or some of the band groups, which then use the
+    # calibration solutions recorded by the calibrator job.
+    parser = OptionParser(usage="%prog [options] parset")
+    parser.add_option("--calibrator-only", action="store_true", default=False,
+        help="only calibrate the calibrator subbands"
+    )
+    parser.add_option("--groups", default="",
+        help="comma-separated band groups (eg SAP000_band0) to process"
+    )
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a parset is required")
+    if options.calibrator_only and options.groups:
+        parser.error("--calibrator-only and --groups are mutually exclusive")
+    input_parset = lofar.parameterset.parameterset(args[0])
+    groups = [name for name in options.groups.split(",") if name]
+    run_calibrator = not groups
+
+    # External processes are packed onto the node according to their CPU
+    # and memory footprints. Footprints which aren't declared in the parset
+    # are learned from earlier runs.
+    resources.manager = resources.from_parset(
+        input_parset,
+        history=os.path.join(input_parset.getString("output_dir"), "resources.json")
+    )
+
+    # Performance metrics for every task and external process are written
+    # to metrics.jsonl alongside the target data products; summarize them
+    # with metrics.py.
+    metrics.recorder = metrics.Recorder(input_parset.getString(
+        "metrics.file",
+        os.path.join(
+            input_parset.getString("output_dir"),
+            "target",
+            input_parset.getString("target_obsid"),
+            metrics.METRICS_FILENAME
+        )
+    ))
+    make_directory(os.path.dirname(metrics.recorder.filename))
+
+    # The output of every external process goes to its own log file, in
+    # logs/<stage> alongside the target data products, rather than to our
+    # stdout. Each process runs in its own working directory in scratch, and
+    # any logs it writes there are collected alongside. Tools may be given
+    # timeouts after which they are killed and retried.
+    supervisor.processes = supervisor.from_parset(
+        input_parset,
+        log_dir=os.path.join(
+            input_parset.getString("output_dir"),
+            "target",
+            input_parset.getString("target_obsid"),
+            "logs"
+        ),
+        work_dir=scratch
+    )
 
     # We require `sbs_per_beam` input MeasurementSets for each beam, including
     # the calibrator.
     sbs_per_beam = sum(input_parset.getIntVector("band_size"))
 
     print "Locating calibrator data and checking paths"
+    # "inputs" are the MSs on shared storage; "datafiles" are the copies we
+    # will process, which are made by the copy stage.
+    # Metadata of the input MSs are looked up in the catalogue, if there is
+    # one, instead of being read from each MS.
+    catalogue = None
+    if input_parset.isDefined("catalogue"):
+        catalogue = Catalogue(input_parset.getString("catalogue"))
+
     ms_cal = {}
-    ms_cal["datafiles"] = read_ms_list(input_parset.getString("cal_ms_list"))
-    assert(len(ms_cal["datafiles"]) == sbs_per_beam)
+    ms_cal["inputs"] = read_ms_list(input_parset.getString("cal_ms_list"))
+    assert(len(ms_cal["inputs"]) == sbs_per_beam)
     ms_cal["output_dir"] = os.path.join(
         input_parset.getString("output_dir"),
         "calibrator",
         input_parset.getString("cal_obsid")
     )
     make_directory(ms_cal["output_dir"])
-
-    print "Copying calibrator subbands to output"
-    ms_cal["datafiles"] = copy_to_work_area(ms_cal["datafiles"], ms_cal["output_dir"])
+    ms_cal["datafiles"] = [
+        os.path.join(ms_cal["output_dir"], os.path.basename(ms))
+        for ms in ms_cal["inputs"]
+    ]
 
     print "Locating target data and checking paths"
     # ms_target will be a dict that provides all the information we need to
@@ -70,8 +164,15 @@ if __name__ == "__main__":
     for beam, data in enumerate(zip(*[iter(target_mss)]*sbs_per_beam)):
         start_sb = 0
         for band, band_size in enumerate(input_parset.getIntVector("band_size")):
-            target_info = {}
-            target_info['datafiles'] = target_mss[start_sb:start_sb+band_size]
+            if options.calibrator_only or (groups and group_name(beam, band) not in groups):
+                start_sb += band_size
+                continue
+            target_info = {"beam": beam, "band": band}
+            target_info['inputs'] = data[start_sb:start_sb+band_size]
+            target_info['datafiles'] = [
+                os.path.join(scratch, os.path.basename(ms))
+                for ms in target_info['inputs']
+            ]
             target_info['calfiles' ] = ms_cal["datafiles"][start_sb:start_sb+band_size]
             assert(len(target_info['datafiles']) == len(target_info['calfiles']))
 
@@ -84,43 +185,82 @@ if __name__ == "__main__":
 
             make_directory(target_info["output_dir"])
 
+            # Outputs may exist from an earlier, interrupted, run: the
+            # manifest determines whether they are complete.
             target_info["output_ms"] = os.path.join(target_info["output_dir"], "%s_SAP00%d_band%d.MS" % (input_parset.getString("target_obsid"), beam, band))
-            assert(not os.path.exists(target_info["output_ms"]))
             target_info["output_im"] = os.path.join(target_info["output_dir"], "%s_SAP00%d_band%d.img" % (input_parset.getString("target_obsid"), beam, band))
-            assert(not os.path.exists(target_info["output_im"]))
-            pointing = map(math.degrees, table("%s::FIELD" % target_info["datafiles"][0]).getcol("REFERENCE_DIR")[0][0])
+            ra, dec = target_info["pointing"] = pointing(target_info["inputs"][0], catalogue)
             target_info["skymodel"] = os.path.join(
                 input_parset.getString("skymodel_dir"),
-                "%.2f_%.2f.skymodel" % (pointing[0], pointing[1])
+                "%.2f_%.2f.skymodel" % (ra, dec)
             )
             assert(os.path.exists(target_info["skymodel"]))
-            ms_target["SAP00%d_band%d" % (beam, band)] = target_info
+            ms_target[group_name(beam, band)] = target_info
             start_sb += band_size
+    if set(groups) - set(ms_target):
+        parser.error("unknown groups: %s" % (", ".join(set(groups) - set(ms_target)),))
 
-    # Copy to working directories
-    for name in ms_target.iterkeys():
-        print "Copying %s to scratch area" % (name,)
-        ms_target[name]["datafiles"] = copy_to_work_area(
-            ms_target[name]["datafiles"], scratch
-        )
-
-    # We'll run as many simultaneous jobs as we have CPUs
-    pool = ThreadPool(cpu_count())
+    # Copy to working directories: calibrator subbands to the output
+    # directory, target subbands to scratch.
+    def copy_ms(ms, work_area, stage):
+        print "Copying %s to %s" % (ms, work_area)
+        copy_to_work_area([ms], work_area, stage)
 
     # Calibration of each calibrator subband
-    os.chdir(ms_cal['output_dir']) # Logs will get dumped here
-    clear_calibrate_stand_alone_logs()
     calcal_parset = get_parset_subset(input_parset, "calcal.parset", scratch)
+
+    # Clipped calibration solutions may be shared between work units which
+    # use the same calibrator observation, through a cache on shared storage.
+    # A cached solution is only applied, so then the calibrator data is
+    # corrected with it in a correct-only pass. So that the cache lock covers
+    # everything needed to produce a solution, clipping is then part of the
+    # calibrate stage.
+    solutions = None
+    if input_parset.isDefined("calcache.directory"):
+        solutions = Cache(
+            input_parset.getString("calcache.directory"),
+            int(input_parset.getFloat("calcache.max_size", 0) * 1e9) or None
+        )
+        calcal_correct_parset = patch_parset(
+            calcal_parset, {"Strategy.Steps": "[correct]"}, scratch
+        )
+    # Calibrator sources are looked up here rather than by the tasks, so
+    # that the catalogue is only used from this thread.
+    cal_sources = dict(
+        (cal, observation_target(ms, catalogue).lower().replace(' ', ''))
+        for ms, cal in zip(ms_cal["inputs"], ms_cal["datafiles"])
+    )
     def calibrate_calibrator(cal):
-        source = table("%s::OBSERVATION" % (cal,)).getcol("LOFAR_TARGET")['array'][0].lower().replace(' ', '')
+        source = cal_sources[cal]
         skymodel = os.path.join(
             input_parset.getString("skymodel_dir"),
             "%s.skymodel" % (source,)
         )
-        print "Calibrating %s with skymodel %s" % (cal, skymodel)
-        run_calibrate_standalone(calcal_parset, cal, skymodel, replace_parmdb=True, replace_sourcedb=True)
-    with time_code("Calibration of calibrator"):
-        pool.map(calibrate_calibrator, ms_cal["datafiles"])
+        if not solutions:
+            print "Calibrating %s with skymodel %s" % (cal, skymodel)
+            run_calibrate_standalone(calcal_parset, cal, skymodel, replace_parmdb=True, replace_sourcedb=True)
+            return
+        description = {
+            "cal_obsid": input_parset.getString("cal_obsid"),
+            "subband": os.path.basename(cal),
+            "parset": file_hash(calcal_parset),
+            "skymodel": file_hash(skymodel),
+            "sigma": input_parset.getFloat("pdbclip.sigma")
+        }
+        key = solutions.key(**description)
+        with solutions.lock(key):
+            if solutions.get(key, os.path.join(cal, "instrument")):
+                print "Applying cached solution to %s" % (cal,)
+                run_calibrate_standalone(calcal_correct_parset, cal, skymodel, replace_sourcedb=True)
+            else:
+                print "Calibrating %s with skymodel %s" % (cal, skymodel)
+                run_calibrate_standalone(calcal_parset, cal, skymodel, replace_parmdb=True, replace_sourcedb=True)
+                clip_parmdb(cal)
+                solutions.put(key, os.path.join(cal, "instrument"), **description)
+                # Correct with the clipped solution, as when it is cached, so
+                # that the calibrator data doesn't depend on whether it was.
+                print "Applying clipped solution to %s" % (cal,)
+                run_calibrate_standalone(calcal_correct_parset, cal, skymodel, replace_sourcedb=True)
 
     # Clip calibrator parmdbs
     def clip_parmdb(sb):
@@ -130,139 +270,367 @@ if __name__ == "__main__":
             "--sigma=%f" % (input_parset.getFloat("pdbclip.sigma"),),
             os.path.join(sb, "instrument")
         )
-    with time_code("Clip calibrator instrument databases"):
-        pool.map(lambda sb: clip_parmdb(sb), ms_cal["datafiles"])
 
     # Transfer calibration solutions to targets
     transfer_parset = get_parset_subset(input_parset, "transfer.parset", scratch)
     transfer_skymodel = input_parset.getString("transfer.skymodel")
-    clear_calibrate_stand_alone_logs()
-    def transfer_calibration(ms_pair):
-        cal, target = ms_pair
-        print "Transferring solution from %s to %s" % (cal, target)
+    def transfer_calibration(cal, targets):
+        # The solution is exported once, and shared by all the target
+        # subbands at the same frequency.
         parmdb_name = mkdtemp(dir=scratch)
-        run_process("parmexportcal", "in=%s/instrument/" % (cal,), "out=%s" % (parmdb_name,))
-        run_process("calibrate-stand-alone", "--parmdb", parmdb_name, target, transfer_parset, transfer_skymodel)
-    with time_code("Transfer of calibration solutions"):
-        for target in ms_target.itervalues():
-            pool.map(transfer_calibration, zip(target["calfiles"], target["datafiles"]))
+        try:
+            print "Exporting solution from %s" % (cal,)
+            run_process("parmexportcal", "in=%s/instrument/" % (cal,), "out=%s" % (parmdb_name,))
+            for target in targets:
+                print "Transferring solution from %s to %s" % (cal, target)
+                run_process("calibrate-stand-alone", "--parmdb", parmdb_name, target, transfer_parset, transfer_skymodel)
+        finally:
+            shutil.rmtree(parmdb_name, ignore_errors=True)
 
     # Combine with NDPPP
+    combine_parset = get_parset_subset(input_parset, "combine.parset", scratch)
     def combine_ms(target_info):
         output = os.path.join(mkdtemp(dir=scratch), "combined.MS")
         run_ndppp(
-            get_parset_subset(input_parset, "combine.parset", scratch),
+            combine_parset,
             {
                 "msin": str(target_info["datafiles"]),
                 "msout": output
             }
         )
-        target_info["combined_ms"] = output
-    with time_code("Combining target subbands"):
-        pool.map(combine_ms, ms_target.values())
-
+        return {"combined_ms": output}
 
     # Phase only calibration of combined target subbands
-    print "Running phase only calibration"
+    phaseonly_parset = get_parset_subset(input_parset, "phaseonly.parset", scratch)
     def phaseonly(target_info):
-        # We chdir to the scratch directory initially, so that logs get dumped
-        # there, then we'll copy the logs to the output directory when we're
-        # done.
         try:
-            os.chdir(os.path.dirname(target_info["combined_ms"]))
             run_calibrate_standalone(
-                get_parset_subset(input_parset, "phaseonly.parset", scratch),
+                phaseonly_parset,
                 target_info["combined_ms"],
                 target_info["skymodel"]
             )
-            for logfile in glob.glob(
-                os.path.join(
-                    os.path.dirname(target_info["combined_ms"]),
-                    "*log"
-                )
-            ):
-                shutil.copy(logfile, target_info["output_dir"])
         except Exception, e:
             print "Error in phaseonly with %s" % (target_info["combined_ms"])
             print str(e)
             raise
 
-    # Most Lisa nodes have 24 GB RAM -- we don't want to run out
-    calpool = ThreadPool(6)
-    with time_code("Phase-only calibration"):
-        calpool.map(phaseonly, ms_target.values())
-
     # Strip bad stations.
     # Note that the combined, calibrated, stripped MS is one of our output
     # data products, so we save that with the name specified in the parset.
+    # Only the data columns listed in strip.data_columns (by default, all of
+    # them) are saved.
+    data_columns = None
+    if input_parset.isDefined("strip.data_columns"):
+        data_columns = input_parset.getStringVector("strip.data_columns")
+    # Bad stations are found by comparing the mean amplitude of each station
+    # with the others, in process (strip.method native), or using
+    # asciistats.py and statsplot.py (strip.method scripts).
+    strip_method = input_parset.getString("strip.method", "scripts")
+    assert(strip_method in ("native", "scripts"))
+    # The band groups of a beam share their time samples and baselines, so
+    # the rows to keep when stripping and limiting baselines are selected
+    # using a row layout shared by the beam, and the UVW column is only read
+    # once per beam. The rows kept by each group are held here rather than
+    # in the task results, which are recorded in the manifest; a resumed run
+    # which skips the strip stage limits baselines with a query instead.
+    row_layouts = dict(
+        (target_info["beam"], RowLayout()) for target_info in ms_target.itervalues()
+    )
+    strip_rows = {}
     def strip_bad_stations(target_info):
-        bad_stations = find_bad_stations(target_info["combined_ms"], scratch)
-        strip_stations(target_info["combined_ms"], target_info["output_ms"], bad_stations)
-    with time_code("Strip bad stations"):
-        pool.map(strip_bad_stations, ms_target.values())
+        if strip_method == "native":
+            bad_stations = detect_bad_stations(
+                target_info["combined_ms"],
+                input_parset.getString("strip.column", "DATA"),
+                input_parset.getFloat("strip.threshold", 5.)
+            )
+        else:
+            bad_stations = find_bad_stations(target_info["combined_ms"], scratch)
+        if os.path.exists(target_info["output_ms"]):
+            shutil.rmtree(target_info["output_ms"])
+        name = group_name(target_info["beam"], target_info["band"])
+        strip_rows[name] = strip_stations(
+            target_info["combined_ms"], target_info["output_ms"], bad_stations,
+            data_columns, layout=row_layouts[target_info["beam"]]
+        )
 
     # Limit the length of the baselines we're using.
     # We'll image a reference table using only the short baselines.
     maxbl = input_parset.getFloat("limit.max_baseline")
     def limit_bl(target_info):
-        target_info["bl_limit_ms"] = mkdtemp(dir=scratch)
-        limit_baselines(target_info["output_ms"], target_info["bl_limit_ms"], maxbl)
-    with time_code("Limiting maximum baseline length"):
-        pool.map(limit_bl, ms_target.values())
+        bl_limit_ms = mkdtemp(dir=scratch)
+        limit_baselines(
+            target_info["output_ms"], bl_limit_ms, maxbl,
+            layout=row_layouts[target_info["beam"]],
+            rows=strip_rows.get(group_name(target_info["beam"], target_info["band"]))
+        )
+        return {"bl_limit_ms": bl_limit_ms}
 
     # We source a special build for using the "new" awimager
     awim_init = input_parset.getString("awimager.initscript")
 
     # Calculate the threshold for cleaning based on the noise in a dirty map
-    # We don't use our threadpool here, since awimager is parallelized
+    # or, if noise.method is "visibility", directly from the scatter of the
+    # Stokes V visibilities, which saves an awimager run for every group.
+    noise_method = input_parset.getString("noise.method", "image")
+    assert(noise_method in ("image", "visibility"))
     noise_parset_name = get_parset_subset(input_parset, "noise.parset", scratch)
-    with time_code("Calculating threshold for cleaning"):
-        for target_info in ms_target.values():
-            print "Getting threshold for %s" % target_info["output_ms"]
-            target_info["threshold"] = input_parset.getFloat("noise.multiplier") * estimate_noise(
+    def calculate_threshold(target_info):
+        print "Getting threshold for %s" % target_info["output_ms"]
+        if noise_method == "visibility":
+            noise = input_parset.getFloat("noise.visibility_factor", 1.0) * visibility_noise(
+                target_info["bl_limit_ms"],
+                input_parset.getString("noise.parset.data", "CORRECTED_DATA")
+            )
+        else:
+            noise = estimate_noise(
                 target_info["bl_limit_ms"],
                 noise_parset_name,
                 maxbl,
-                input_parset.getFloat("noise.box_size"),
-                scratch
+                input_parset.getInt("noise.box_size"),
+                scratch,
+                estimator=input_parset.getString("noise.estimator", "std")
             )
-            print "Threshold for %s is %f Jy" % (target_info["output_ms"], target_info["threshold"])
+        threshold = input_parset.getFloat("noise.multiplier") * noise
+        print "Threshold for %s is %f Jy" % (target_info["output_ms"], threshold)
+        return {"threshold": threshold}
 
     # Make a mask for cleaning
     aw_parset_name = get_parset_subset(input_parset, "image.parset", scratch)
-    with time_code("Making mask"):
-        for target_info in ms_target.values():
+    mask_template = input_parset.getString("make_mask.template", "awimager")
+
+    # The beams revisit the same pointings, so masks may be shared between
+    # work units through a cache on shared storage, like the calibration
+    # solutions. A mask depends only on the skymodel and the image geometry.
+    masks = None
+    if input_parset.isDefined("maskcache.directory"):
+        masks = Cache(
+            input_parset.getString("maskcache.directory"),
+            int(input_parset.getFloat("maskcache.max_size", 0) * 1e9) or None
+        )
+        aw_parset = lofar.parameterset.parameterset(aw_parset_name)
+    def make_mask_for(target_info):
+        # The check template is always made afresh, so that it is checked.
+        if not masks or mask_template == "check":
             print "Making mask for %s" % target_info["output_ms"]
-            target_info["mask"] = make_mask(
+            return {"mask": make_mask(
                 target_info["bl_limit_ms"],
                 aw_parset_name,
                 target_info["skymodel"],
-                input_parset.getString("make_mask.executable"),
                 scratch,
-                awim_init=awim_init
+                awim_init=awim_init,
+                template=mask_template
+            )}
+        description = {
+            "skymodel": file_hash(target_info["skymodel"]),
+            "cellsize": aw_parset.getString("cellsize"),
+            "npix": aw_parset.getInt("npix"),
+            "stokes": aw_parset.getString("stokes"),
+            "padding": aw_parset.getFloat("padding", 1.0),
+            "pointing": ["%.6f" % (angle,) for angle in target_info["pointing"]],
+            "frequency": reference_frequency(target_info["bl_limit_ms"]),
+            "template": mask_template
+        }
+        key = masks.key(**description)
+        with masks.lock(key):
+            mask = mkdtemp(dir=scratch)
+            if masks.get(key, mask, link=True):
+                print "Using cached mask for %s" % target_info["output_ms"]
+                return {"mask": mask}
+            shutil.rmtree(mask)
+            print "Making mask for %s" % target_info["output_ms"]
+            mask = make_mask(
+                target_info["bl_limit_ms"],
+                aw_parset_name,
+                target_info["skymodel"],
+                scratch,
+                awim_init=awim_init,
+                template=mask_template
             )
-
-    with time_code("Making images"):
-        for target_info in ms_target.values():
-            print "Making image %s" % target_info["output_im"]
-            print run_awimager(aw_parset_name,
-                {
-                    "ms": target_info["bl_limit_ms"],
-                    "mask": target_info["mask"],
-                    "threshold": "%fJy" % (target_info["threshold"],),
-                    "image": target_info["output_im"],
-                    "wmax": maxbl
-                },
-                initscript=awim_init
+            masks.put(key, mask, **description)
+        return {"mask": mask}
+
+    def make_image(target_info):
+        # Clear out anything left by an interrupted run
+        for product in glob.glob(target_info["output_im"] + "*"):
+            shutil.rmtree(product)
+        print "Making image %s" % target_info["output_im"]
+        print run_awimager(aw_parset_name,
+            {
+                "ms": target_info["bl_limit_ms"],
+                "mask": target_info["mask"],
+                "threshold": "%fJy" % (target_info["threshold"],),
+                "image": target_info["output_im"],
+                "wmax": maxbl
+            },
+            initscript=awim_init
+        )
+        print "Updaging metadata in %s" % target_info["output_im"]
+        run_process(
+            "addImagingInfo",
+            "%s.restored.corr" % target_info["output_im"],
+            "", # No sky model specified
+            "0",
+            str(maxbl),
+            target_info["output_ms"]
+        )
+        print "Saving mask for %s to %s" % (target_info["output_im"], target_info["output_im"] + ".mask")
+        shutil.copytree(target_info["mask"], target_info["output_im"] + ".mask")
+        return {"image": "%s.restored.corr" % target_info["output_im"]}
+
+    # Each band group moves through the stages below as soon as its own
+    # inputs are ready, rather than waiting at the end of each stage for
+    # every other group. The number of simultaneous tasks in each slot is
+    # limited by scheduler.limit.<slot> in the parset.
+    # Completed tasks are recorded in the work unit's manifest, so that if
+    # we are re-run after being interrupted we only redo unfinished work.
+    # Intermediates in scratch are deleted as soon as the last task which
+    # needs them has finished. Tasks which copy data to scratch are held
+    # back while they would take it over scratch.quota GB.
+    scratch_manager = ScratchManager(
+        scratch, int(input_parset.getFloat("scratch.quota", 0) * 1e9) or None
+    )
+    limits = dict(DEFAULT_LIMITS)
+    limit_parset = input_parset.makeSubset("scheduler.limit.", "")
+    for slot in limit_parset.keys():
+        if slot != "default":
+            limits[slot] = limit_parset.getInt(slot)
+    # If the awimager scaling has been measured by `benchmark.py imaging`,
+    # run the number of instances it found fastest, each bound to its own
+    # CPUs.
+    imaging_config = input_parset.getString("imaging.config", "")
+    if imaging_config and os.path.exists(imaging_config):
+        with open(imaging_config, "r") as f:
+            config = json.load(f)
+        print "Running %d awimager instance(s) of %d thread(s), from %s" % (
+            config["instances"], config["threads"], imaging_config
+        )
+        limits["awimager"] = config["instances"]
+        resources.manager.footprints.setdefault("awimager", {}).update(
+            cpus=config["threads"], pin=1
+        )
+    scheduler = Scheduler(
+        limits=limits,
+        default_limit=input_parset.getInt("scheduler.limit.default", cpu_count()),
+        manifest=Manifest(os.path.join(
+            input_parset.getString("output_dir"),
+            "target",
+            input_parset.getString("target_obsid"),
+            "manifest"
+        )),
+        scratch=scratch_manager
+    )
+    # The task which completes the solution for each calibrator subband.
+    solved = "calibrate" if solutions else "clip"
+    # When only some groups are processed, the calibrator must already have
+    # been completed by another job.
+    if not run_calibrator:
+        for cal in ms_cal["datafiles"]:
+            if not scheduler.manifest.satisfied("%s %s" % (solved, os.path.basename(cal))):
+                print "Calibrator subband %s has not been processed" % (cal,)
+                sys.exit(1)
+    calibrator_mss = zip(ms_cal["inputs"], ms_cal["datafiles"]) if run_calibrator else []
+    for ms, cal in calibrator_mss:
+        sb = os.path.basename(cal)
+        tags = {"beam": "calibrator", "subband": sb}
+        scheduler.add("copy %s" % (sb,), copy_ms, ms, ms_cal["output_dir"],
+            "copy calibrator", stage="copy", artifacts=[cal], tags=tags
+        )
+        scheduler.add("calibrate %s" % (sb,), calibrate_calibrator, cal,
+            stage="calibrate", depends=["copy %s" % (sb,)], artifacts=[cal],
+            tags=tags
+        )
+        if not solutions:
+            scheduler.add("clip %s" % (sb,), clip_parmdb, cal, stage="clip",
+                depends=["calibrate %s" % (sb,)],
+                artifacts=[os.path.join(cal, "instrument")], tags=tags
             )
-            print "Updaging metadata in %s" % target_info["output_im"]
-            run_process(
-                "addImagingInfo",
-                "%s.restored.corr" % target_info["output_im"],
-                "", # No sky model specified
-                "0",
-                str(maxbl),
-                target_info["output_ms"]
+    # Only the image method of calculating the threshold runs awimager.
+    noise_slot = "awimager" if noise_method == "image" else "noise"
+    mask_slot = "mask" if mask_template == "native" else "awimager"
+    # Each calibrator subband's solution is transferred to the target
+    # subbands at the same frequency in every beam by a single task.
+    targets_by_cal = OrderedDict((cal, []) for cal in ms_cal["datafiles"])
+    for name, target_info in ms_target.iteritems():
+        group_tags = {"beam": target_info["beam"], "band": target_info["band"]}
+        for ms, cal, target in zip(
+            target_info["inputs"], target_info["calfiles"], target_info["datafiles"]
+        ):
+            sb = os.path.basename(target)
+            scheduler.add("copy %s" % (sb,), copy_ms, ms, scratch,
+                "copy target", stage="copy", artifacts=[target],
+                tags=dict(group_tags, subband=sb),
+                scratch=lambda ms=ms: tree_size(ms)
+            )
+            targets_by_cal[cal].append((target_info["beam"], target))
+    transfer_tasks = {}
+    for cal, targets in targets_by_cal.iteritems():
+        if not targets:
+            continue
+        targets.sort()
+        sb = os.path.basename(cal)
+        # Name the beams, since jobs processing different groups may each
+        # transfer this solution to some of them.
+        transfer_tasks[cal] = scheduler.add(
+            "transfer %s to %s" % (sb, ",".join("SAP00%d" % (beam,) for beam, target in targets)),
+            transfer_calibration, cal, [target for beam, target in targets],
+            stage="transfer",
+            depends=["copy %s" % (os.path.basename(target),) for beam, target in targets] + (
+                ["%s %s" % (solved, sb)] if run_calibrator else []
+            ),
+            artifacts=[target for beam, target in targets], tags={"subband": sb}
+        )
+    for name, target_info in ms_target.iteritems():
+        group_tags = {"beam": target_info["beam"], "band": target_info["band"]}
+        transfers = [transfer_tasks[cal] for cal in target_info["calfiles"]]
+        # The copies of the target subbands are needed until they have been
+        # combined, the combined MS until the bad stations have been stripped
+        # from it, and the limited-baseline MS and mask until imaging.
+        for target, cal in zip(target_info["datafiles"], target_info["calfiles"]):
+            scratch_manager.track([target], [transfer_tasks[cal], "combine %s" % (name,)])
+        scratch_manager.track(
+            lambda target_info=target_info: [os.path.dirname(target_info["combined_ms"])],
+            ["phaseonly %s" % (name,), "strip %s" % (name,)]
+        )
+        scratch_manager.track(
+            lambda target_info=target_info: [target_info["bl_limit_ms"]],
+            ["noise %s" % (name,), "mask %s" % (name,), "image %s" % (name,)]
+        )
+        scratch_manager.track(
+            lambda target_info=target_info: [target_info["mask"]] + glob.glob(target_info["mask"] + ".*"),
+            ["image %s" % (name,)]
+        )
+        # Each stage of a group depends on the stages whose outputs it uses.
+        # Artifacts are looked up when the stage completes.
+        for stage, function, slot, depends, artifacts, size in [
+            ("combine", combine_ms, "combine", transfers, ["combined_ms"],
+                lambda target_info=target_info: sum(
+                    tree_size(ms) for ms in target_info["datafiles"]
+                )
+            ),
+            ("phaseonly", phaseonly, "phaseonly", ["combine"], ["combined_ms"], 0),
+            ("strip", strip_bad_stations, "strip", ["phaseonly"], ["output_ms"], 0),
+            ("limit", limit_bl, "limit", ["strip"], ["bl_limit_ms"], 0),
+            ("noise", calculate_threshold, noise_slot, ["limit"], [], 0),
+            ("mask", make_mask_for, mask_slot, ["limit"], ["mask"], 0),
+            ("image", make_image, "awimager", ["strip", "limit", "noise", "mask"], ["image"], 0)
+        ]:
+            scheduler.add("%s %s" % (stage, name), function, target_info,
+                stage=stage, slot=slot,
+                depends=[
+                    dependency if dependency in transfers else "%s %s" % (dependency, name)
+                    for dependency in depends
+                ],
+                artifacts=lambda target_info=target_info, artifacts=artifacts: [
+                    target_info[key] for key in artifacts
+                ],
+                apply=lambda result, target_info=target_info: target_info.update(result or {}),
+                tags=group_tags, scratch=size
             )
-            print "Saving mask for %s to %s" % (target_info["output_im"], target_info["output_im"] + ".mask")
-            shutil.copytree(target_info["mask"], target_info["output_im"] + ".mask")
+    try:
+        with time_code("Processing work unit"):
+            scheduler.run()
+    finally:
+        staging.throughput.report()
+        supervisor.processes.report()
+        scratch_manager.report()
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import hashlib
+from tempfile import mkstemp
+
+from utility import make_directory
+
+
+def fingerprint(path):
+    """
+    Checksum identifying the current state of the file or directory tree
+    `path`, or None if it doesn't exist.
+
+    This is calculated from the name, size and modification time of every
+    file rather than their contents: MeasurementSets are far too large to
+    read just to decide whether they need to be regenerated.
+    """
+    if not os.path.exists(path):
+        return None
+    checksum = hashlib.md5()
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                st = os.stat(full_path)
+                checksum.update("%s %d %d\n" % (
+                    os.path.relpath(full_path, path), st.st_size, int(st.st_mtime)
+                ))
+    else:
+        st = os.stat(path)
+        checksum.update("%d %d\n" % (st.st_size, int(st.st_mtime)))
+    return checksum.hexdigest()
+
+
+class Manifest(object):
+    """
+    Persistent record of the tasks in a work unit which have completed, with
+    their results and the fingerprints of the artifacts they produced.
+
+    Each task is recorded in its own JSON file in `directory`, which is
+    replaced atomically, so concurrent tasks (or jobs) never conflict.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        make_directory(directory)
+
+    def _filename(self, name):
+        return os.path.join(
+            self.directory, hashlib.md5(name).hexdigest() + ".json"
+        )
+
+    def get(self, name):
+        """
+        Return the record of task `name`, or None if it hasn't completed.
+        """
+        try:
+            with open(self._filename(name), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def satisfied(self, name):
+        """
+        True if task `name` has completed and all of its artifacts are
+        unchanged since.
+        """
+        record = self.get(name)
+        if not record:
+            return False
+        for path, checksum in record["artifacts"].iteritems():
+            if fingerprint(path) != checksum:
+                return False
+        return True
+
+    def record(self, name, stage, result, artifacts):
+        fd, temp_name = mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "task": name,
+                    "stage": stage,
+                    "finished": time.time(),
+                    "result": result,
+                    "artifacts": dict((path, fingerprint(path)) for path in artifacts)
+                }, f, indent=4, sort_keys=True)
+            os.chmod(temp_name, 0644)
+            os.rename(temp_name, self._filename(name))
+        except:
+            os.unlink(temp_name)
+            raise
+
+    def remove(self, name):
+        try:
+            os.unlink(self._filename(name))
+        except OSError:
+            pass
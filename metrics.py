@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# Structured performance metrics.
+#
+# Every external process run by utility.run_process, every copy made by
+# staging.stage_tree and every block timed by utility.time_code is recorded
+# as one JSON object per line in the file configured on `recorder`, tagged
+# with whatever tags (stage, beam, band, ...) are in effect in the calling
+# thread.
+#
+# Usage: ./metrics.py run [run ...]
+#
+# Summarizes the per-stage cost of each run, where a run is a metrics file or
+# a directory searched recursively for metrics files (for example, the output
+# directory of a night's work units). Given more than one run, the change in
+# each stage relative to the first run is also shown.
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Name of the metrics file written for each work unit
+METRICS_FILENAME = "metrics.jsonl"
+
+# Bytes per block in ru_inblock and ru_oublock
+BLOCK_SIZE = 512
+
+_local = threading.local()
+
+
+def current_tags():
+    return dict(getattr(_local, "tags", {}))
+
+
+@contextmanager
+def tags(**kwargs):
+    """
+    Add `kwargs` to the tags applied to metrics recorded by this thread.
+    """
+    previous = current_tags()
+    _local.tags = dict(previous, **kwargs)
+    try:
+        yield
+    finally:
+        _local.tags = previous
+
+
+class Recorder(object):
+    """
+    Append metrics to `filename` as JSON lines. If `filename` is None,
+    metrics are discarded.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, **values):
+        if not self.filename:
+            return
+        entry = current_tags()
+        entry.update(values)
+        entry.update({"kind": kind, "name": name, "time": time.time()})
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+recorder = Recorder()
+
+
+def _usage_totals():
+    return {
+        "processes": 0, "cpu_time": 0., "peak_rss": 0,
+        "read_bytes": 0, "written_bytes": 0
+    }
+
+
+@contextmanager
+def measure(name):
+    """
+    Record the wall clock time taken by the enclosed block, together with
+    the total CPU time, peak RSS and I/O of the external processes it ran.
+    """
+    usage = _usage_totals()
+    stack = getattr(_local, "usage", [])
+    _local.usage = stack + [usage]
+    start_time = time.time()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        _local.usage = stack
+        recorder.record(
+            "block", name, status=status, wall_time=time.time() - start_time,
+            **usage
+        )
+
+
+def _accumulate(usage):
+    # Add `usage` to the totals of every enclosing measure() block.
+    for totals in getattr(_local, "usage", []):
+        for key, value in usage.iteritems():
+            if key == "peak_rss":
+                totals[key] = max(totals[key], value)
+            else:
+                totals[key] += value
+
+
+def record_process(executable, wall_time, rusage, returncode):
+    """
+    Record the resources used by a finished external process, as reported
+    by os.wait4(), and add them to every enclosing measure() block.
+    """
+    usage = {
+        "processes": 1,
+        "cpu_time": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss": rusage.ru_maxrss * 1024, # kB on Linux
+        "read_bytes": rusage.ru_inblock * BLOCK_SIZE,
+        "written_bytes": rusage.ru_oublock * BLOCK_SIZE,
+    }
+    _accumulate(usage)
+    recorder.record(
+        "process", os.path.basename(executable), wall_time=wall_time,
+        returncode=returncode, user_time=rusage.ru_utime,
+        system_time=rusage.ru_stime, **usage
+    )
+
+
+def record_transfer(source, wall_time, copied, skipped):
+    """
+    Record a copy of `copied` bytes made by this process, and add it to
+    every enclosing measure() block.
+    """
+    _accumulate({"read_bytes": copied, "written_bytes": copied})
+    recorder.record(
+        "transfer", source, wall_time=wall_time, read_bytes=copied,
+        written_bytes=copied, skipped_bytes=skipped
+    )
+
+
+def read_run(path):
+    """
+    Return all the entries in the metrics file `path`, or in all metrics
+    files under the directory `path`.
+    """
+    if os.path.isdir(path):
+        filenames = [
+            os.path.join(dirpath, filename)
+            for dirpath, dirnames, filenames in os.walk(path)
+            for filename in filenames if filename == METRICS_FILENAME
+        ]
+    else:
+        filenames = [path]
+    entries = []
+    for filename in filenames:
+        with open(filename, "r") as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    return entries
+
+
+def summarize(entries):
+    """
+    Total the blocks timing whole scheduler tasks in `entries` by stage.
+    """
+    stages = {}
+    for entry in entries:
+        if entry["kind"] != "block" or entry["name"] != entry.get("task"):
+            continue
+        total = stages.setdefault(entry["stage"], dict(
+            _usage_totals(), tasks=0, wall_time=0., max_wall_time=0.
+        ))
+        total["tasks"] += 1
+        total["wall_time"] += entry["wall_time"]
+        total["max_wall_time"] = max(total["max_wall_time"], entry["wall_time"])
+        total["peak_rss"] = max(total["peak_rss"], entry["peak_rss"])
+        for key in ("processes", "cpu_time", "read_bytes", "written_bytes"):
+            total[key] += entry[key]
+    return stages
+
+
+def report(runs):
+    summaries = [summarize(read_run(run)) for run in runs]
+    stages = sorted(set().union(*summaries))
+    for run, summary in zip(runs, summaries):
+        print run
+        print "%-12s %6s %12s %10s %12s %10s %10s %10s" % (
+            "stage", "tasks", "wall (s)", "max (s)", "cpu (s)", "rss (MB)",
+            "read (MB)", "write (MB)"
+        )
+        for stage in sorted(summary, key=lambda x: -summary[x]["wall_time"]):
+            total = summary[stage]
+            print "%-12s %6d %12.1f %10.1f %12.1f %10.1f %10.1f %10.1f" % (
+                stage, total["tasks"], total["wall_time"],
+                total["max_wall_time"], total["cpu_time"],
+                total["peak_rss"] / 1e6, total["read_bytes"] / 1e6,
+                total["written_bytes"] / 1e6
+            )
+        print
+    if len(summaries) > 1:
+        print "Change in total wall time relative to %s" % (runs[0],)
+        for stage in stages:
+            base = summaries[0].get(stage, {}).get("wall_time")
+            changes = []
+            for summary in summaries[1:]:
+                value = summary.get(stage, {}).get("wall_time")
+                if base and value is not None:
+                    changes.append("%+7.1f%%" % (100. * (value - base) / base))
+                else:
+                    changes.append("%8s" % "n/a")
+            print "%-12s %s" % (stage, " ".join(changes))
+
+
+if __name__ == "__main__":
+    report(sys.argv[1:])
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+# Catalogue of MeasurementSet metadata.
+#
+# Usage: ./mscatalogue.py scan <catalogue> <directory> [directory ...]
+#        ./mscatalogue.py list <catalogue> [obsid]
+#
+# `scan` finds every MS under the given directories and records its obsid,
+# SAP and subband (from its name), reference frequency, pointing, target,
+# time range, size and path in the SQLite database <catalogue>, reading them
+# with a pool of worker processes. Only MSs which are new, or which have
+# changed since they were last scanned, are read; MSs which have disappeared
+# are removed. `list` prints what is recorded.
+#
+# generate.py, rename.py, skymodel.py and imaging-multibeam.py query the
+# catalogue, if they are given one, rather than opening the subtables of
+# every MS themselves.
+
+import os
+import re
+import sys
+import math
+import sqlite3
+import warnings
+import multiprocessing
+from pyrap.tables import table
+
+from cache import tree_size
+
+# Fields recorded for each MS, in column order
+FIELDS = [
+    ("path", "TEXT PRIMARY KEY"),
+    ("obsid", "TEXT"),
+    ("sap", "INTEGER"),
+    ("subband", "INTEGER"),
+    ("frequency", "REAL"),     # Reference frequency [Hz]
+    ("ra", "REAL"),            # Pointing [deg]
+    ("dec", "REAL"),
+    ("target", "TEXT"),        # LOFAR_TARGET
+    ("start_time", "REAL"),    # TIME_RANGE [MJD seconds]
+    ("end_time", "REAL"),
+    ("size", "INTEGER"),       # [bytes]
+    ("fingerprint", "REAL"),   # See fingerprint()
+]
+
+# Obsid, SAP and subband of MSs named as by rename.py
+NAME_PATTERN = re.compile(r"(L\d+)_SAP(\d{3})_SB(\d{3})")
+SUBBAND_PATTERN = re.compile(r"SB(\d{3})")
+
+# Seconds to wait for other jobs to release the database
+TIMEOUT = 60.
+
+
+def is_ms(path):
+    return (
+        os.path.isfile(os.path.join(path, "table.dat")) and
+        os.path.isdir(os.path.join(path, "OBSERVATION"))
+    )
+
+
+def find_ms(directory):
+    """
+    Return the paths of all MSs under `directory`.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if is_ms(dirpath):
+            found.append(os.path.abspath(dirpath))
+            # Don't descend into the subtables.
+            del dirnames[:]
+    return found
+
+
+def fingerprint(ms):
+    """
+    The latest modification time of `ms` itself or its table.dat, which
+    changes if the MS is rewritten.
+    """
+    return max(
+        os.stat(ms).st_mtime, os.stat(os.path.join(ms, "table.dat")).st_mtime
+    )
+
+
+def parse_name(ms):
+    """
+    Return the obsid, SAP and subband given by the name of `ms`; those which
+    aren't given are None.
+    """
+    match = NAME_PATTERN.search(os.path.basename(ms))
+    if match:
+        return match.group(1), int(match.group(2)), int(match.group(3))
+    match = SUBBAND_PATTERN.search(os.path.basename(ms))
+    return None, None, int(match.group(1)) if match else None
+
+
+def describe(ms):
+    """
+    Read the metadata of `ms` from its subtables. Returns a dict with the
+    keys in FIELDS.
+    """
+    ms = os.path.abspath(ms)
+    obsid, sap, subband = parse_name(ms)
+    observation = table("%s::OBSERVATION" % (ms,))
+    start_time, end_time = observation.getcol("TIME_RANGE")[0]
+    target = None
+    if "LOFAR_TARGET" in observation.colnames():
+        target = observation.getcol("LOFAR_TARGET")["array"][0]
+    observation.close()
+    ra, dec = pointing(ms)
+    frequency = table("%s::SPECTRAL_WINDOW" % (ms,)).getcol("REF_FREQUENCY")[0]
+    return {
+        "path": ms, "obsid": obsid, "sap": sap, "subband": subband,
+        "frequency": frequency, "ra": ra, "dec": dec, "target": target,
+        "start_time": start_time, "end_time": end_time,
+        "size": tree_size(ms), "fingerprint": fingerprint(ms)
+    }
+
+
+def _describe(ms):
+    # Worker for Catalogue.scan(); errors are reported rather than raised,
+    # so that one bad MS doesn't stop the scan.
+    try:
+        return ms, describe(ms), None
+    except Exception, e:
+        return ms, None, str(e)
+
+
+class Catalogue(object):
+    """
+    Metadata of MeasurementSets, stored in the SQLite database `filename`,
+    which may be shared by several jobs.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(
+            filename, timeout=TIMEOUT, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS ms (%s)" % (
+                ", ".join("%s %s" % field for field in FIELDS),
+            ))
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS ms_obsid ON ms (obsid, sap, subband)"
+            )
+
+    def _store(self, descriptions):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ms VALUES (%s)" % (", ".join("?" * len(FIELDS)),),
+                [
+                    [description[name] for name, kind in FIELDS]
+                    for description in descriptions
+                ]
+            )
+
+    def _fingerprints(self):
+        return dict(self.connection.execute("SELECT path, fingerprint FROM ms"))
+
+    def scan(self, directories, processes=None):
+        """
+        Bring the catalogue up to date with the MSs under `directories`,
+        reading those which are new or changed with `processes` workers.
+        Returns the numbers of MSs read and removed.
+        """
+        known = self._fingerprints()
+        found = set()
+        for directory in directories:
+            found.update(find_ms(directory))
+        changed = [
+            ms for ms in sorted(found)
+            if ms not in known or known[ms] != fingerprint(ms)
+        ]
+        prefixes = tuple(
+            os.path.join(os.path.abspath(directory), "") for directory in directories
+        )
+        removed = [
+            ms for ms in known if ms.startswith(prefixes) and ms not in found
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM ms WHERE path = ?", [(ms,) for ms in removed]
+            )
+
+        descriptions = []
+        if changed:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for ms, description, error in pool.imap_unordered(_describe, changed, 8):
+                    if error:
+                        warnings.warn("Unable to read %s: %s" % (ms, error))
+                    else:
+                        descriptions.append(description)
+            finally:
+                pool.close()
+                pool.join()
+        self._store(descriptions)
+        return len(descriptions), len(removed)
+
+    def get(self, ms):
+        """
+        Return the metadata of `ms`, reading it (and recording it) only if
+        the catalogue doesn't hold an up to date copy.
+        """
+        ms = os.path.abspath(ms)
+        row = self.connection.execute(
+            "SELECT * FROM ms WHERE path = ?", (ms,)
+        ).fetchone()
+        if row and row["fingerprint"] == fingerprint(ms):
+            return dict(row)
+        description = describe(ms)
+        self._store([description])
+        return description
+
+    def query(self, directory=None, **criteria):
+        """
+        Return the metadata of every MS matching `criteria` (field names
+        and values), and within `directory` if given, ordered by obsid, SAP
+        and subband.
+        """
+        where = " AND ".join("%s = ?" % (name,) for name in sorted(criteria))
+        entries = [dict(row) for row in self.connection.execute(
+            "SELECT * FROM ms%s ORDER BY obsid, sap, subband, path" % (
+                " WHERE " + where if where else "",
+            ),
+            [criteria[name] for name in sorted(criteria)]
+        )]
+        if directory:
+            prefix = os.path.join(os.path.abspath(directory), "")
+            entries = [entry for entry in entries if entry["path"].startswith(prefix)]
+        return entries
+
+    def move(self, old, new):
+        """
+        Record that the MS `old` has been moved to `new`.
+        """
+        old, new = os.path.abspath(old), os.path.abspath(new)
+        row = self.connection.execute(
+            "SELECT * FROM ms WHERE path = ?", (old,)
+        ).fetchone()
+        with self.connection:
+            self.connection.execute("DELETE FROM ms WHERE path = ?", (old,))
+        if row:
+            description = dict(row)
+            description["path"] = new
+            description["obsid"], description["sap"], description["subband"] = parse_name(new)
+            description["fingerprint"] = fingerprint(new)
+            self._store([description])
+
+
+# The lookups below use `catalogue` if it is given, and otherwise read just
+# the subtable they need.
+
+def pointing(ms, catalogue=None):
+    """
+    Return the pointing of `ms` as [ra, dec] in degrees.
+    """
+    if catalogue:
+        entry = catalogue.get(ms)
+        return [entry["ra"], entry["dec"]]
+    return map(math.degrees, table("%s::FIELD" % (ms,)).getcol("REFERENCE_DIR")[0][0])
+
+
+def observation_target(ms, catalogue=None):
+    """
+    Return the LOFAR_TARGET of `ms`.
+    """
+    if catalogue:
+        return catalogue.get(ms)["target"]
+    return table("%s::OBSERVATION" % (ms,)).getcol("LOFAR_TARGET")["array"][0]
+
+
+def reference_frequency(ms, catalogue=None):
+    """
+    Return the reference frequency of `ms` in Hz.
+    """
+    if catalogue:
+        return catalogue.get(ms)["frequency"]
+    return table("%s::SPECTRAL_WINDOW" % (ms,)).getcol("REF_FREQUENCY")[0]
+
+
+def start_time(ms, catalogue=None):
+    """
+    Return the start of the observation in `ms`, in MJD seconds.
+    """
+    if catalogue:
+        return catalogue.get(ms)["start_time"]
+    return table("%s::OBSERVATION" % (ms,)).getcol("TIME_RANGE")[0][0]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "scan":
+        read, removed = Catalogue(sys.argv[2]).scan(sys.argv[3:])
+        print "Read %d MSs, removed %d" % (read, removed)
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "list":
+        criteria = {"obsid": sys.argv[3]} if len(sys.argv) == 4 else {}
+        for entry in Catalogue(sys.argv[2]).query(**criteria):
+            print "%(path)s SAP%(sap)s SB%(subband)s %(frequency).0f Hz %(ra).2f %(dec).2f %(target)s" % entry
+    else:
+        print "Usage: %s scan <catalogue> <directory> [directory ...]" % (sys.argv[0],)
+        print "       %s list <catalogue> [obsid]" % (sys.argv[0],)
+        sys.exit(1)
@@ -20,105 +20,253 @@
 # KNOWN BUG
 # * not works with single line skymodels, workaround: add a fake source outside the field
 
-# 
+#
 # Version 0.3  (Wouter Klijn, klijn@astron.nl)
 # * Usage of sourcedb instead of txt document as 'source' of sources
-#   This allows input from different source sources 
+#   This allows input from different source sources
+#
+
+#
+# Version 0.4
+# * The mask is filled by fill_mask(), which can be called as a library
+#   function as well as from the command line.
+# * Pixel world coordinates are calculated once for the whole image with
+#   NumPy rather than by calling toworld() for every pixel, and each source
+#   is rasterized in a single array operation over its bounding box. The
+#   result is written with a single putdata().
+# * The NumPy projection is checked against casacore's own toworld() at a
+#   handful of pixels; they must agree to within WCS_TOLERANCE radians.
+#   Pixel output is therefore identical to version 0.3 except for pixels
+#   whose centres lie within WCS_TOLERANCE of an ellipse boundary.
+# * Right ascension differences are wrapped to [-pi, pi), so sources on the
+#   other side of RA=0 from the image centre are no longer silently lost.
+# * Sources are first culled by their separation from the image centre, in
+#   a single array operation, so only those which can touch the mask are
+#   projected.
+# * The catalogue may again be a skymodel text file, read natively by
+#   sourcelist.load_skymodel(), as well as a sourcedb.
 #
 
 import pyrap.images as pi
+import os
 import sys
 import numpy as np
-import os
-import random
-import re
 import pyrap.tables as pt
 import lofar.parmdb
+from sourcelist import POINT
+from sourcelist import GAUSSIAN
+from sourcelist import SOURCE_DTYPE
+from sourcelist import load_skymodel
 
 pad = 500. # increment in maj/min axes [arcsec]
 
-# open command line arguments
-mask_file = sys.argv[1]
-catalogue = sys.argv[2]
+# Maximum permitted difference between the NumPy and casacore world
+# coordinates of a pixel [rad]; about 2 milliarcsec.
+WCS_TOLERANCE = 1e-8
 
+def read_sourcedb(catalogue):
+    """
+    Read the sources stored in the sourcedb `catalogue` into a structured
+    array with dtype SOURCE_DTYPE.
+    """
+    table = pt.table(catalogue + "::SOURCES")
+    pdb = lofar.parmdb.parmdb(catalogue)
 
-# open mask
-mask = pi.image(mask_file, overwrite = True)
-mask_data = mask.getdata()
-xlen, ylen = mask.shape()[2:]
-freq, stokes, null, null = mask.toworld([0, 0, 0, 0])
+    # Get the data of interest
+    source_list = table.getcol("SOURCENAME")
+    source_type = table.getcol("SOURCETYPE")
+    all_values_dict = pdb.getDefValues()  # All date in the format valuetype:sourcename
+    table.close()
 
+    def get_value(valuetype, source):
+        if valuetype + ":" + source in all_values_dict:
+            return all_values_dict[valuetype + ":" + source][0, 0]
+        return 0.
 
-#Open the sourcedb:
-table = pt.table(catalogue + "::SOURCES")
-pdb = lofar.parmdb.parmdb(catalogue)
+    sources = np.zeros(len(source_list), dtype=SOURCE_DTYPE)
+    for i, (source, type) in enumerate(zip(source_list, source_type)):
+        sources[i] = (
+            source, type,
+            get_value("Ra", source),
+            get_value("Dec", source),
+            get_value("MajorAxis", source),
+            get_value("MinorAxis", source),
+            get_value("Orientation", source)
+        )
+    return sources
 
-# Get the data of interest
-source_list = table.getcol("SOURCENAME")
-source_type = table.getcol("SOURCETYPE")
-all_values_dict = pdb.getDefValues()  # All date in the format valuetype:sourcename
 
-# Loop the sources
-for source, type in zip(source_list, source_type):
-    if type == 1:
-        type_string = "Gaussian"
-    else:
-        type_string = "Point"
-    print "processing: {0} ({1})".format(source, type_string)
-
-    # Get de ra and dec (already in radians)
-    ra = all_values_dict["Ra:" + source][0, 0]
-    dec = all_values_dict["Dec:" + source][0, 0]
-    if type == 1:
-        # Get the raw values from the db
-        maj_raw = all_values_dict["MajorAxis:" + source][0, 0]
-        min_raw = all_values_dict["MinorAxis:" + source][0, 0]
-        pa_raw = all_values_dict["Orientation:" + source][0, 0]
-        #convert to radians (conversion is copy paste JDS)
-        maj = (((maj_raw + pad)) / 3600.) * np.pi / 180. # major radius (+pad) in rad
-        min = (((min_raw + pad)) / 3600.) * np.pi / 180. # minor radius (+pad) in rad
-        pa = pa_raw * np.pi / 180.
-        if maj == 0 or min == 0: # wenss writes always 'GAUSSIAN' even for point sources -> set to wenss beam+pad
-            maj = ((54. + pad) / 3600.) * np.pi / 180.
-            min = ((54. + pad) / 3600.) * np.pi / 180.
-    elif type == 0: # set to wenss beam+pad
-        maj = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
-        min = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
-        pa = 0.
+def mask_axes(sources, pad=pad):
+    """
+    Return the semi-major axis, semi-minor axis and position angle, all in
+    radians, of the ellipse drawn in the mask for each of `sources`.
+    """
+    gaussian = sources["type"] == GAUSSIAN
+    # convert to radians (conversion is copy paste JDS)
+    maj = np.where(
+        gaussian,
+        np.radians((sources["major"] + pad) / 3600.), # major radius (+pad)
+        np.radians(((54. + pad) / 2.) / 3600.)        # wenss beam+pad
+    )
+    min = np.where(
+        gaussian,
+        np.radians((sources["minor"] + pad) / 3600.), # minor radius (+pad)
+        np.radians(((54. + pad) / 2.) / 3600.)        # wenss beam+pad
+    )
+    pa = np.where(gaussian, np.radians(sources["orientation"]), 0.)
+    # wenss writes always 'GAUSSIAN' even for point sources -> set to wenss beam+pad
+    degenerate = gaussian & ((maj == 0) | (min == 0))
+    maj[degenerate] = np.radians((54. + pad) / 3600.)
+    min[degenerate] = np.radians((54. + pad) / 3600.)
+    return maj, min, pa
+
+
+class SinProjection(object):
+    """
+    NumPy implementation of the SIN (orthographic) projection used by the
+    direction axes of an awimager image. Pixel coordinates are (y, x) in the
+    same order as the image data; world coordinates are (dec, ra) in
+    radians.
+    """
+    def __init__(self, image):
+        direction = image.coordinates().get_coordinate("direction")
+        if direction.get_projection() != "SIN":
+            raise ValueError(
+                "Unsupported projection %s" % (direction.get_projection(),)
+            )
+        to_rad = np.array([
+            {"rad": 1., "deg": np.pi / 180.}[unit]
+            for unit in direction.get_unit()
+        ])
+        self.dec0, self.ra0 = np.array(direction.get_referencevalue()) * to_rad
+        self.y0, self.x0 = direction.get_referencepixel()
+        self.dy, self.dx = np.array(direction.get_increment()) * to_rad
+
+    def toworld(self, y, x):
+        l = (np.asarray(x) - self.x0) * self.dx
+        m = (np.asarray(y) - self.y0) * self.dy
+        n = np.sqrt(1. - l**2 - m**2)
+        dec = np.arcsin(m * np.cos(self.dec0) + n * np.sin(self.dec0))
+        ra = self.ra0 + np.arctan2(l, n * np.cos(self.dec0) - m * np.sin(self.dec0))
+        return dec, ra
+
+    def topixel(self, dec, ra):
+        dra = np.asarray(ra) - self.ra0
+        l = np.cos(dec) * np.sin(dra)
+        m = np.sin(dec) * np.cos(self.dec0) - np.cos(dec) * np.sin(self.dec0) * np.cos(dra)
+        return m / self.dy + self.y0, l / self.dx + self.x0
+
+
+def wrap_angle(angle):
+    """
+    Wrap `angle` (in radians) to the range [-pi, pi).
+    """
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Great circle distance between (ra1, dec1) and (ra2, dec2), all in
+    radians.
+    """
+    return 2 * np.arcsin(np.sqrt(
+        np.sin((dec2 - dec1) / 2.) ** 2 +
+        np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.) ** 2
+    ))
+
+
+def check_projection(image, projection, tolerance=WCS_TOLERANCE):
+    """
+    Raise ValueError if `projection` disagrees with casacore's conversion of
+    pixel to world coordinates in `image` by more than `tolerance` radians
+    at the corners or centre of the image.
+    """
+    ylen, xlen = image.shape()[2:]
+    for y, x in [
+        (0, 0), (0, xlen - 1), (ylen - 1, 0), (ylen - 1, xlen - 1),
+        (ylen // 2, xlen // 2)
+    ]:
+        null, null, dec, ra = image.toworld([0, 0, y, x])
+        np_dec, np_ra = projection.toworld(y, x)
+        if abs(np_dec - dec) > tolerance or abs(wrap_angle(np_ra - ra)) > tolerance:
+            raise ValueError(
+                "Projection mismatch at pixel (%d, %d): (%r, %r) != (%r, %r)" %
+                (y, x, np_dec, np_ra, dec, ra)
+            )
+
+
+def fill_mask(mask_file, sources, pad=pad):
+    """
+    Set to 1 every pixel of the image `mask_file` which falls within the
+    (padded) ellipse of any of `sources`, a structured array with dtype
+    SOURCE_DTYPE.
+    """
+    # open mask
+    mask = pi.image(mask_file, overwrite = True)
+    mask_data = mask.getdata()
+    ylen, xlen = mask.shape()[2:]
+
+    projection = SinProjection(mask)
+    check_projection(mask, projection)
+
+    # get pixel ra and dec in rad
+    pix_dec, pix_ra = projection.toworld(*np.mgrid[0:ylen, 0:xlen])
+
+    known = (sources["type"] == POINT) | (sources["type"] == GAUSSIAN)
+    for source in sources[~known]:
+        print "WARNING: unknown source type ({0}), ignoring it.".format(source["type"])
+    sources = sources[known]
+    maj, min, pa = mask_axes(sources, pad)
+
+    # Only sources within the field radius plus their own extent (and that
+    # of their bounding box) can touch the mask.
+    centre_dec, centre_ra = projection.toworld(ylen // 2, xlen // 2)
+    field_radius = np.nanmax(angular_separation(
+        centre_ra, centre_dec, pix_ra[::ylen - 1, ::xlen - 1], pix_dec[::ylen - 1, ::xlen - 1]
+    ))
+    near = np.flatnonzero(
+        angular_separation(centre_ra, centre_dec, sources["ra"], sources["dec"]) <=
+        field_radius + 2 * (maj.max() if len(maj) else 0.)
+    )
+    print "%d of %d sources fall near the mask" % (len(near), len(sources))
+    sources, maj, min, pa = sources[near], maj[near], min[near], pa[near]
+    ra, dec = sources["ra"], sources["dec"]
+
+    # define a small square around each source to look for it
+    y1, x1 = projection.topixel(dec - maj, ra - maj / np.cos(dec - maj))
+    y2, x2 = projection.topixel(dec + maj, ra + maj / np.cos(dec + maj))
+    xmin = np.floor(np.minimum(x1, x2)).astype(int)
+    xmax = np.ceil(np.maximum(x1, x2)).astype(int)
+    ymin = np.floor(np.minimum(y1, y2)).astype(int)
+    ymax = np.ceil(np.maximum(y1, y2)).astype(int)
+
+    outside = (xmin > xlen) | (ymin > ylen) | (xmax < 0) | (ymax < 0)
+    for source in sources[outside]:
+        print "WARNING: source ", source["name"], "falls outside the mask, ignoring it."
+    edge = ~outside & ((xmax > xlen) | (ymax > ylen) | (xmin < 0) | (ymin < 0))
+    for source in sources[edge]:
+        print "WARNING: source ", source["name"], "falls across map edge."
+
+    for i in np.flatnonzero(~outside):
+        # skip pixels outside the mask field
+        ys = slice(np.clip(ymin[i], 0, ylen), np.clip(ymax[i], 0, ylen))
+        xs = slice(np.clip(xmin[i], 0, xlen), np.clip(xmax[i], 0, xlen))
+        d_ra = wrap_angle(pix_ra[ys, xs] - ra[i])
+        d_dec = pix_dec[ys, xs] - dec[i]
+        X = d_ra * np.sin(pa[i]) + d_dec * np.cos(pa[i]) # Translate and rotate coords.
+        Y = -d_ra * np.cos(pa[i]) + d_dec * np.sin(pa[i]) # to align with ellipse
+        mask_data[0, 0, ys, xs][X ** 2 / maj[i] ** 2 + Y ** 2 / min[i] ** 2 < 1] = 1
+
+    mask.putdata(mask_data)
+    return mask_file
+
+
+if __name__ == "__main__":
+    # open command line arguments
+    mask_file = sys.argv[1]
+    catalogue = sys.argv[2]
+    if os.path.isdir(catalogue):
+        sources = read_sourcedb(catalogue)
     else:
-        print "WARNING: unknown source type ({0}), ignoring it.".format(type)
-        continue
-
-    #print "Maj = ", maj*180*3600/np.pi, " - Min = ", min*180*3600/np.pi # DEBUG
-
-    # define a small square around the source to look for it
-    null, null, y1, x1 = mask.topixel([freq, stokes, dec - maj, ra - maj / np.cos(dec - maj)])
-    null, null, y2, x2 = mask.topixel([freq, stokes, dec + maj, ra + maj / np.cos(dec + maj)])
-    xmin = np.int(np.floor(np.min([x1, x2])))
-    xmax = np.int(np.ceil(np.max([x1, x2])))
-    ymin = np.int(np.floor(np.min([y1, y2])))
-    ymax = np.int(np.ceil(np.max([y1, y2])))
-
-    if xmin > xlen or ymin > ylen or xmax < 0 or ymax < 0:
-        print "WARNING: source ", source, "falls outside the mask, ignoring it."
-        continue
-
-    if xmax > xlen or ymax > ylen or xmin < 0 or ymin < 0:
-        print "WARNING: source ", source, "falls across map edge."
-
-
-    for x in xrange(xmin, xmax):
-        for y in xrange(ymin, ymax):
-            # skip pixels outside the mask field
-            if x >= xlen or y >= ylen or x < 0 or y < 0:
-                continue
-            # get pixel ra and dec in rad
-            null, null, pix_dec, pix_ra = mask.toworld([0, 0, y, x])
-
-            X = (pix_ra - ra) * np.sin(pa) + (pix_dec - dec) * np.cos(pa); # Translate and rotate coords.
-            Y = -(pix_ra - ra) * np.cos(pa) + (pix_dec - dec) * np.sin(pa); # to align with ellipse
-            if X ** 2 / maj ** 2 + Y ** 2 / min ** 2 < 1:
-                mask_data[0, 0, y, x] = 1
-
-mask.putdata(mask_data)
-table.close()
+        sources = load_skymodel(catalogue)
+    fill_mask(mask_file, sources)
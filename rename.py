@@ -18,10 +18,11 @@
 # Where LXXXXX is the *obsid* as given in the observations.txt file.
 #
 # Customize INPUT_ROOT, OUTPUT_ROOT and BEAM_EDGES, below to control the
-# output.
+# output. If CATALOGUE names an MS catalogue (see mscatalogue.py), INPUT_ROOT
+# is scanned into it first, in parallel, and the observation times are taken
+# from it; the catalogue is kept up to date as MSs are moved.
 
 from __future__ import division
-import pyrap.tables as pt
 import datetime
 import os
 import re
@@ -29,9 +30,13 @@ import sys
 import shutil
 import pytz
 
+from mscatalogue import Catalogue
+from mscatalogue import start_time
+
 INPUT_ROOT = "/home/jswinban/RSM_run2_sorted"
 OUTPUT_ROOT = "/home/jswinban/RSM_run2"
 BEAM_EDGES = [40, 80, 120, 160, 200, 240, 244]
+CATALOGUE = None
 
 julian_epoch = datetime.datetime(1858, 11, 17)
 unix_epoch = datetime.datetime(1970, 1, 1, 0, 0)
@@ -51,10 +56,14 @@ with open("observations.txt", "r") as obs_file:
         date = datetime.datetime.strptime(line[60:80].strip(), "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.utc)
         obs_mapping[date] = obsid
 
+catalogue = None
+if CATALOGUE:
+    catalogue = Catalogue(CATALOGUE)
+    catalogue.scan([INPUT_ROOT])
+
 for (ms, dirnames, filenames) in os.walk(INPUT_ROOT, topdown=False):
     if ms[-2:] == "MS":
-        t = pt.table("%s::OBSERVATION" % (ms,))
-        obs_date = datetime.datetime.fromtimestamp(mjds_to_unix(t.getcol("TIME_RANGE")[0][0]), pytz.utc)
+        obs_date = datetime.datetime.fromtimestamp(mjds_to_unix(start_time(ms, catalogue)), pytz.utc)
         obsid = obs_mapping[obs_date]
         obs_subband = re.search(r"SB([0-9]{3})", ms).groups()[0]
         obs_sap = sb_to_sap(int(obs_subband))
@@ -66,4 +75,6 @@ for (ms, dirnames, filenames) in os.walk(INPUT_ROOT, topdown=False):
             pass
         if os.path.abspath(ms) != os.path.abspath(target):
             shutil.move(ms, target)
+            if catalogue:
+                catalogue.move(ms, target)
             print "Moved %s to %s" % (ms, target)
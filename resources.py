@@ -0,0 +1,221 @@
+import os
+import json
+import threading
+import warnings
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from tempfile import mkstemp
+
+# Memory (MB) which must remain available on the node before another process
+# is started.
+RESERVE_MEMORY = 1024
+
+# Learned footprints are scaled by this factor to leave some headroom.
+LEARNED_MARGIN = 1.2
+
+# How often (s) waiting processes re-check the memory available on the node.
+POLL_INTERVAL = 5
+
+
+def read_meminfo(filename="/proc/meminfo"):
+    """
+    Return a dict of the values (in MB) listed in `filename`.
+    """
+    meminfo = {}
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) / 1024
+    except (IOError, OSError):
+        pass
+    return meminfo
+
+
+def allowed_cpus(filename="/proc/self/status"):
+    """
+    Return the numbers of the CPUs this process may run on.
+    """
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    cpus = []
+                    for item in line.split(":", 1)[1].strip().split(","):
+                        first, _, last = item.partition("-")
+                        cpus.extend(range(int(first), int(last or first) + 1))
+                    return cpus
+    except (IOError, OSError, ValueError):
+        pass
+    return range(cpu_count())
+
+
+def available_memory():
+    """
+    Memory (MB) currently available for new processes on this node, or None
+    if it can't be determined.
+    """
+    meminfo = read_meminfo()
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"]
+    if "MemFree" in meminfo:
+        return meminfo["MemFree"] + meminfo.get("Cached", 0) + meminfo.get("Buffers", 0)
+    return None
+
+
+class ResourceManager(object):
+    """
+    Admit external processes only when the node has enough free CPUs and
+    memory for them.
+
+    `cpus` and `memory` (MB) are the totals available; by default, the
+    whole node. `footprints` maps tool name (the basename of the executable)
+    to a dict which may contain "cpus" and "memory". Tools without a
+    declared memory footprint use the peak RSS recorded for them in
+    `history`, a JSON file which is updated as processes finish.
+
+    A process is started if its footprint fits within the unreserved CPUs
+    and memory, and if the memory actually available on the node would not
+    fall below RESERVE_MEMORY. A process is always started if nothing else
+    is running, so that an oversized footprint cannot deadlock.
+
+    Each running process is allotted a set of CPU numbers, disjoint from
+    those of other processes as far as the node's CPUs allow. Tools
+    whose footprint includes a true "pin" value are bound to that set by
+    utility.run_process, so that several multi-threaded processes can share
+    the node without competing for cores.
+    """
+    def __init__(self, cpus=None, memory=None, footprints=None, history=None):
+        self.cpus = cpus or len(allowed_cpus())
+        self.memory = memory or read_meminfo().get("MemTotal")
+        self.footprints = footprints or {}
+        self.history = history
+        self.learned = {}
+        if history and os.path.exists(history):
+            with open(history, "r") as f:
+                self.learned = json.load(f)
+        self.cpus_used = 0
+        # Number of running processes allotted each CPU
+        self.cpu_users = dict((cpu, 0) for cpu in allowed_cpus())
+        self.memory_used = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def footprint(self, tool):
+        """
+        Return the (cpus, memory) footprint of `tool`.
+        """
+        declared = self.footprints.get(tool, {})
+        cpus = declared.get("cpus", 1)
+        if "memory" in declared:
+            memory = declared["memory"]
+        else:
+            memory = int(self.learned.get(tool, 0) * LEARNED_MARGIN)
+        return min(cpus, self.cpus), memory
+
+    def pinned(self, tool):
+        return bool(self.footprints.get(tool, {}).get("pin"))
+
+    def _fits(self, cpus, memory):
+        if not self.running:
+            return True
+        if self.cpus_used + cpus > self.cpus:
+            return False
+        if self.memory and self.memory_used + memory > self.memory:
+            return False
+        available = available_memory()
+        if available is not None and available - memory < RESERVE_MEMORY:
+            return False
+        return True
+
+    @contextmanager
+    def reserve(self, tool):
+        """
+        Block until there is room to run `tool`, and hold its footprint until
+        the context exits. Yields the list of CPU numbers allotted to it.
+        """
+        cpus, memory = self.footprint(tool)
+        with self.condition:
+            while not self._fits(cpus, memory):
+                # Memory pressure can change without anybody notifying us,
+                # so poll.
+                self.condition.wait(POLL_INTERVAL)
+            # The least used CPUs: disjoint from those of other processes,
+            # unless more CPUs have been declared than actually exist.
+            allotted = sorted(
+                sorted(self.cpu_users), key=lambda cpu: self.cpu_users[cpu]
+            )[:cpus]
+            for cpu in allotted:
+                self.cpu_users[cpu] += 1
+            self.cpus_used += cpus
+            self.memory_used += memory
+            self.running += 1
+        try:
+            yield allotted
+        finally:
+            with self.condition:
+                for cpu in allotted:
+                    self.cpu_users[cpu] -= 1
+                self.cpus_used -= cpus
+                self.memory_used -= memory
+                self.running -= 1
+                self.condition.notify_all()
+
+    def record(self, tool, peak_rss):
+        """
+        Record that `tool` used `peak_rss` MB at its peak.
+        """
+        with self.condition:
+            if peak_rss <= self.learned.get(tool, 0):
+                return
+            self.learned[tool] = peak_rss
+            if self.history:
+                self._save()
+
+    def _save(self):
+        # Merge with whatever other jobs have written since we started.
+        try:
+            if os.path.exists(self.history):
+                with open(self.history, "r") as f:
+                    for tool, peak_rss in json.load(f).iteritems():
+                        self.learned[tool] = max(self.learned.get(tool, 0), peak_rss)
+            fd, temp_name = mkstemp(dir=os.path.dirname(os.path.abspath(self.history)))
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.learned, f, indent=4, sort_keys=True)
+            os.chmod(temp_name, 0644)
+            os.rename(temp_name, self.history)
+        except (IOError, OSError, ValueError), e:
+            warnings.warn("Unable to update %s: %s" % (self.history, e))
+
+
+def from_parset(parset, history=None):
+    """
+    Create a ResourceManager configured by the resources.* keys in `parset`:
+
+    resources.cpus, resources.memory
+        Node totals; default to the whole node.
+    resources.history
+        JSON file of learned footprints; defaults to `history`.
+    resources.tool.<tool>.cpus, resources.tool.<tool>.memory
+        Declared footprint of <tool>.
+    resources.tool.<tool>.pin
+        If non-zero, bind <tool> to the CPUs it is allotted.
+    """
+    subset = parset.makeSubset("resources.", "")
+    footprints = {}
+    for key in subset.keys():
+        if key.startswith("tool."):
+            tool, resource = key[len("tool."):].rsplit(".", 1)
+            footprints.setdefault(tool, {})[resource] = subset.getInt(key)
+    return ResourceManager(
+        cpus=subset.getInt("cpus", 0) or None,
+        memory=subset.getInt("memory", 0) or None,
+        footprints=footprints,
+        history=subset.getString("history", "") or history
+    )
+
+
+# Every call to utility.run_process is admitted by this manager. Without
+# configuration, each process is assumed to use one CPU, and none are started
+# while the node is short of memory.
+manager = ResourceManager()
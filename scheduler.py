@@ -0,0 +1,264 @@
+import time
+import threading
+import traceback
+from Queue import Queue
+from Queue import Empty
+from collections import OrderedDict
+from multiprocessing import cpu_count
+
+import metrics
+from utility import time_code
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class Task(object):
+    def __init__(self, name, function, args, depends, stage, slot, artifacts, apply, tags, scratch):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.depends = list(depends)
+        self.stage = stage
+        self.slot = slot
+        self.artifacts = artifacts
+        self.apply = apply
+        self.tags = tags
+        self.scratch = scratch
+        self.result = None
+
+    def get_artifacts(self):
+        if callable(self.artifacts):
+            return self.artifacts()
+        return self.artifacts
+
+    def get_scratch(self):
+        # Evaluated once, since estimating may be expensive.
+        if callable(self.scratch):
+            self.scratch = self.scratch()
+        return self.scratch
+
+
+class Scheduler(object):
+    """
+    Run a graph of interdependent tasks, starting each task as soon as all of
+    the tasks it depends on have finished.
+
+    Every task belongs to a stage, and is run in a slot (by default, named
+    after its stage). The number of tasks running simultaneously in a slot is
+    limited by `limits`, a dict mapping slot name to limit; slots which are
+    not listed are limited to `default_limit` (by default, the number of
+    CPUs).
+
+    If a task fails, the tasks which depend on it are cancelled, but
+    independent tasks run to completion. SchedulerError is then raised.
+
+    If a `manifest` is supplied, completed tasks are recorded in it, and
+    tasks which it shows have already completed with unchanged artifacts are
+    not re-run (see plan()).
+
+    If a `scratch` manager (see scratch.ScratchManager) is supplied, a task
+    is only started when the scratch space it declares fits within the
+    quota (or nothing else is running), and is released once it has
+    completed (or been skipped), so that the intermediates it consumes can
+    be deleted.
+    """
+    def __init__(self, limits=None, default_limit=None, manifest=None, scratch=None):
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit or cpu_count()
+        self.manifest = manifest
+        self.scratch = scratch
+        self.tasks = OrderedDict()
+
+    def add(self, name, function, *args, **kwargs):
+        """
+        Add a task `name` which calls `function(*args)`.
+
+        Keyword arguments `depends` (a list of task names), `stage` and `slot`
+        are also accepted, as are:
+
+        artifacts
+            Paths produced by the task, or a callable returning them after
+            the task has run, which are recorded in the manifest.
+        apply
+            A callable which is passed the task's result when it completes,
+            or the recorded result if it is skipped.
+        tags
+            A dict of tags (for example, beam and band) applied to the
+            metrics recorded while the task runs, in addition to its stage.
+        scratch
+            The number of bytes of scratch space the task will write, or a
+            callable returning it.
+
+        Task names should be stable between runs. Returns `name`.
+        """
+        if name in self.tasks:
+            raise SchedulerError("Duplicate task %s" % (name,))
+        stage = kwargs.get("stage", name)
+        self.tasks[name] = Task(
+            name, function, args, kwargs.get("depends", []), stage,
+            kwargs.get("slot", stage), kwargs.get("artifacts", []),
+            kwargs.get("apply"), kwargs.get("tags", {}), kwargs.get("scratch", 0)
+        )
+        return name
+
+    def limit(self, slot):
+        return self.limits.get(slot, self.default_limit)
+
+    def _execute(self, task, finished):
+        try:
+            if self.manifest:
+                self.manifest.remove(task.name)
+            with metrics.tags(stage=task.stage, task=task.name, **task.tags):
+                try:
+                    with time_code(task.name):
+                        task.result = task.function(*task.args)
+                finally:
+                    if self.scratch:
+                        self.scratch.unreserve(task.get_scratch())
+            if task.apply:
+                task.apply(task.result)
+            if self.manifest:
+                self.manifest.record(
+                    task.name, task.stage, task.result, task.get_artifacts()
+                )
+            if self.scratch:
+                self.scratch.release(task.name)
+        except Exception, e:
+            print "Error in %s" % (task.name,)
+            traceback.print_exc()
+            finished.put((task.name, e))
+        else:
+            finished.put((task.name, None))
+
+    def _dependents(self, name):
+        # All tasks which depend on `name`, directly or indirectly.
+        dependents = set()
+        stack = [name]
+        while stack:
+            current = stack.pop()
+            for task in self.tasks.itervalues():
+                if current in task.depends and task.name not in dependents:
+                    dependents.add(task.name)
+                    stack.append(task.name)
+        return dependents
+
+    def _check(self):
+        for task in self.tasks.itervalues():
+            for dependency in task.depends:
+                if dependency not in self.tasks:
+                    raise SchedulerError(
+                        "%s depends on unknown task %s" % (task.name, dependency)
+                    )
+
+    def plan(self):
+        """
+        Return the set of names of tasks which must be run.
+
+        Without a manifest, that's every task. Otherwise, a task must be run
+        if it has not been satisfied (completed with unchanged artifacts),
+        and either nothing depends on it or some other task which must be
+        run does. A task must also be re-run if anything it depends on is.
+        """
+        self._check()
+        if not self.manifest:
+            return set(self.tasks)
+        satisfied = set(
+            name for name in self.tasks if self.manifest.satisfied(name)
+        )
+        dependents = dict((name, set()) for name in self.tasks)
+        for task in self.tasks.itervalues():
+            for dependency in task.depends:
+                dependents[dependency].add(task.name)
+        needed = set()
+        changed = True
+        while changed:
+            changed = False
+            for name, task in self.tasks.iteritems():
+                if name in needed:
+                    continue
+                if (
+                    name not in satisfied and
+                    (not dependents[name] or dependents[name] & needed)
+                ) or needed.intersection(task.depends):
+                    needed.add(name)
+                    changed = True
+        return needed
+
+    def run(self):
+        """
+        Run all tasks, returning a dict mapping task name to result.
+        """
+        needed = self.plan()
+        for name, task in self.tasks.iteritems():
+            if name in needed:
+                continue
+            record = self.manifest.get(name)
+            if record:
+                print "Skipping %s: completed at %s" % (name, time.ctime(record["finished"]))
+                task.result = record["result"]
+                if task.apply:
+                    task.apply(task.result)
+            else:
+                print "Skipping %s: not required" % (name,)
+            if self.scratch:
+                self.scratch.release(name)
+
+        waiting = OrderedDict(
+            (name, set(task.depends) & needed)
+            for name, task in self.tasks.iteritems() if name in needed
+        )
+        running = dict((task.slot, 0) for task in self.tasks.itervalues())
+        finished = Queue()
+        failed, cancelled = {}, set()
+        in_flight = 0
+
+        while waiting or in_flight:
+            for name, dependencies in waiting.items():
+                task = self.tasks[name]
+                if dependencies or running[task.slot] >= self.limit(task.slot):
+                    continue
+                if self.scratch:
+                    if in_flight and not self.scratch.fits(task.get_scratch()):
+                        continue
+                    self.scratch.reserve(task.get_scratch())
+                del waiting[name]
+                running[task.slot] += 1
+                in_flight += 1
+                thread = threading.Thread(
+                    target=self._execute, args=(task, finished)
+                )
+                thread.daemon = True
+                thread.start()
+
+            if not in_flight:
+                raise SchedulerError(
+                    "Unsatisfiable dependencies: %s" % (", ".join(waiting),)
+                )
+
+            # Use a timeout so that we remain responsive to KeyboardInterrupt
+            while True:
+                try:
+                    name, error = finished.get(True, 1)
+                    break
+                except Empty:
+                    pass
+            in_flight -= 1
+            running[self.tasks[name].slot] -= 1
+            if error:
+                failed[name] = error
+                for dependent in self._dependents(name):
+                    if dependent in waiting:
+                        del waiting[dependent]
+                        cancelled.add(dependent)
+            else:
+                for dependencies in waiting.itervalues():
+                    dependencies.discard(name)
+
+        if failed:
+            raise SchedulerError(
+                "%d task(s) failed (%s); %d cancelled" %
+                (len(failed), ", ".join(failed), len(cancelled))
+            )
+        return dict((name, task.result) for name, task in self.tasks.iteritems())
@@ -0,0 +1,152 @@
+import os
+import time
+import shutil
+import threading
+
+from cache import tree_size
+import metrics
+
+# Seconds between walks of the scratch directory to measure its usage, other
+# than those needed to enforce a quota
+MEASURE_INTERVAL = 60
+
+
+class ScratchManager(object):
+    """
+    Keep track of the intermediate data products written to the scratch
+    `directory`, delete them as soon as nothing else needs them, and keep
+    the total within `quota` bytes, if given.
+
+    Each intermediate is registered with track(), naming the tasks which
+    consume it; it is deleted once all of them have been released. Tasks
+    declare how much they expect to write, and are only started while
+    fits() shows there is room for it; the scheduler starts a task anyway if
+    nothing else is running, so that an underestimated quota cannot
+    deadlock.
+
+    Usage is adjusted by the size of the intermediates as they are deleted.
+    The directory is only walked to measure it again after each task which
+    reserved space if there is a quota, and otherwise every MEASURE_INTERVAL
+    seconds, so the peak usage reported is sampled.
+    """
+    def __init__(self, directory, quota=None):
+        self.directory = os.path.abspath(directory)
+        self.quota = quota
+        self.tracked = []
+        self.used = self.measure()
+        self.peak = self.used
+        self.reserved = 0
+        self.condition = threading.Condition()
+        self.last_measured = time.time()
+        self.measuring = False
+
+    def measure(self):
+        """
+        Return the number of bytes currently in the scratch directory.
+        """
+        try:
+            return tree_size(self.directory)
+        except OSError:
+            # Files may disappear while we're walking the tree.
+            return self.used
+
+    def track(self, paths, consumers):
+        """
+        Delete `paths` once every task in `consumers` has been released.
+        `paths` may be a callable returning the list of paths, evaluated
+        only when they are deleted; paths outside the scratch directory are
+        never deleted.
+        """
+        with self.condition:
+            self.tracked.append((paths, set(consumers)))
+
+    def fits(self, size):
+        """
+        True if `size` more bytes can be written without exceeding the
+        quota, allowing for the space reserved by running tasks.
+        """
+        with self.condition:
+            if not self.quota or not size:
+                return True
+            return self.used + self.reserved + size <= self.quota
+
+    def reserve(self, size):
+        with self.condition:
+            self.reserved += size
+
+    def unreserve(self, size):
+        """
+        Return a reservation made by a task which has finished writing.
+        """
+        with self.condition:
+            self.reserved -= size
+        self._update(force=bool(self.quota and size))
+
+    def _update(self, force=False):
+        # Measure the directory if `force`d or it is due, without holding
+        # the lock while walking it, and with one walk at a time.
+        with self.condition:
+            if self.measuring or not (
+                force or time.time() > self.last_measured + MEASURE_INTERVAL
+            ):
+                return
+            self.measuring = True
+        try:
+            used = self.measure()
+        finally:
+            with self.condition:
+                self.measuring = False
+        with self.condition:
+            self.used = used
+            self.peak = max(self.peak, used)
+            self.last_measured = time.time()
+
+    def release(self, consumer):
+        """
+        Record that `consumer` has finished with its inputs, deleting any
+        intermediates which are no longer needed.
+        """
+        with self.condition:
+            doomed = []
+            for paths, consumers in self.tracked:
+                consumers.discard(consumer)
+                if not consumers:
+                    doomed.append(paths)
+            self.tracked = [item for item in self.tracked if item[1]]
+        freed = 0
+        for paths in doomed:
+            for path in self._resolve(paths):
+                print "Removing %s from scratch" % (path,)
+                try:
+                    freed += tree_size(path)
+                except OSError:
+                    pass
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.unlink(path)
+        with self.condition:
+            self.used = max(self.used - freed, 0)
+        self._update()
+
+    def _resolve(self, paths):
+        if callable(paths):
+            try:
+                paths = paths()
+            except KeyError:
+                # Never produced
+                return []
+        return [
+            path for path in paths
+            if os.path.abspath(path).startswith(self.directory + os.sep)
+        ]
+
+    def report(self):
+        self._update(force=True)
+        print "Peak scratch usage in %s: %.1f MB%s" % (
+            self.directory, self.peak / 1e6,
+            " (quota %.1f MB)" % (self.quota / 1e6,) if self.quota else ""
+        )
+        metrics.recorder.record(
+            "scratch", self.directory, peak_bytes=self.peak, quota=self.quota
+        )
@@ -1,18 +1,29 @@
+# Usage: ./skymodel.py [--catalogue <catalogue>] <directory> [directory ...]
+#
+# With --catalogue, pointings are taken from (and, if need be, recorded in)
+# the given MS catalogue (see mscatalogue.py) rather than read from each MS.
+
 import os
 import sys
 import glob
-import math
-from pyrap.tables import table
+
+from mscatalogue import Catalogue
+from mscatalogue import pointing
 
 # One from each beam
 important_subbands = ["000", "040", "080", "120", "160", "200"]
 positions = []
 
-for arg in sys.argv[1:]:
+catalogue = None
+args = sys.argv[1:]
+if args[:1] == ["--catalogue"]:
+    catalogue = Catalogue(args[1])
+    args = args[2:]
+
+for arg in args:
     for sb in important_subbands:
         for msname in glob.glob(os.path.join(arg, "L*SB%s_uv.MS.dppp" % (sb,))):
-            t = table("%s::FIELD" % (msname,))
-            positions.append(map(math.degrees, t.getcol("REFERENCE_DIR")[0][0]))
+            positions.append(pointing(msname, catalogue))
 
 #print positions
 for posn in positions:
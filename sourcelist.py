@@ -0,0 +1,182 @@
+# Read BBS/makesourcedb format skymodels into NumPy structured arrays.
+#
+# A skymodel starts with a format line naming its columns, optionally with
+# default values:
+#
+# # (Name, Type, Ra, Dec, I, ReferenceFrequency='150.e6', SpectralIndex) = format
+#
+# followed by one source per line. Lines defining patches (with empty name
+# and type) and comments are skipped.
+
+import os
+import re
+import errno
+import math
+import hashlib
+import warnings
+import threading
+import numpy as np
+from tempfile import mkstemp
+
+# Source types as stored in the SOURCETYPE column of a sourcedb.
+POINT = 0
+GAUSSIAN = 1
+SOURCE_TYPES = {"POINT": POINT, "GAUSSIAN": GAUSSIAN}
+
+# A catalogue of sources is a structured array with one row per source.
+# Positions are in radians, axes in arcsec and orientation in degrees, as
+# they are stored in a sourcedb.
+SOURCE_DTYPE = [
+    ("name", "S64"),
+    ("type", "i4"),
+    ("ra", "f8"),
+    ("dec", "f8"),
+    ("major", "f8"),
+    ("minor", "f8"),
+    ("orientation", "f8"),
+]
+
+# Skymodel columns providing each field of SOURCE_DTYPE
+COLUMNS = {
+    "name": "name",
+    "type": "type",
+    "ra": "ra",
+    "dec": "dec",
+    "major": "majoraxis",
+    "minor": "minoraxis",
+    "orientation": "orientation",
+}
+
+# Name of the on-disk cache directory, relative to the skymodel
+CACHE_DIRNAME = ".skymodel_cache"
+
+# Split on commas which are not inside a [list]
+FIELD_SEPARATOR = re.compile(r",(?![^\[]*\])")
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def parse_angle(value):
+    """
+    Convert an angle in one of the formats accepted by makesourcedb to
+    radians: hh:mm:ss.s (hours), dd.mm.ss.s (degrees) or a number with an
+    optional unit of rad or deg. Numbers without a unit are in radians.
+    """
+    value = value.strip()
+    sign = -1. if value.startswith("-") else 1.
+    if ":" in value:
+        h, m, s = value.lstrip("+-").split(":")
+        return sign * math.radians(15. * (float(h) + float(m) / 60. + float(s) / 3600.))
+    if value.count(".") > 1:
+        d, m, s = value.lstrip("+-").split(".", 2)
+        return sign * math.radians(float(d) + float(m) / 60. + float(s) / 3600.)
+    if value.endswith("deg"):
+        return math.radians(float(value[:-3]))
+    if value.endswith("rad"):
+        return float(value[:-3])
+    return float(value)
+
+
+def parse_format(line):
+    """
+    Parse a format line, returning a list of lower-cased column names and a
+    list of their default values (or empty strings).
+    """
+    columns, defaults = [], []
+    body = line.lstrip("# ").rsplit("=", 1)[0].strip().lstrip("(").rstrip(")")
+    for column in FIELD_SEPARATOR.split(body):
+        name, _, default = column.partition("=")
+        columns.append(name.strip().lower())
+        defaults.append(default.strip().strip("'\""))
+    return columns, defaults
+
+
+def read_skymodel(filename):
+    """
+    Read the BBS format skymodel `filename` into a structured array with
+    dtype SOURCE_DTYPE.
+    """
+    columns, defaults = ["name", "type", "ra", "dec"], ["", "", "", ""]
+    rows = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#") and line.endswith("format"):
+                columns, defaults = parse_format(line)
+                continue
+            if not line or line.startswith("#"):
+                continue
+            fields = [x.strip() for x in FIELD_SEPARATOR.split(line)]
+            fields += [""] * (len(columns) - len(fields))
+            fields = [x or default for x, default in zip(fields, defaults)]
+            # Patch definitions have no name or type
+            if not fields[0] and not fields[1]:
+                continue
+            value = {}
+            for field, column in COLUMNS.iteritems():
+                if column in columns:
+                    value[field] = fields[columns.index(column)]
+                else:
+                    value[field] = ""
+            rows.append((
+                value["name"],
+                SOURCE_TYPES.get(value["type"].upper(), -1),
+                parse_angle(value["ra"]),
+                parse_angle(value["dec"]),
+                float(value["major"] or 0.),
+                float(value["minor"] or 0.),
+                float(value["orientation"] or 0.)
+            ))
+    return np.array(rows, dtype=SOURCE_DTYPE)
+
+
+def cache_filename(filename, cache_dir):
+    """
+    Name of the cache file for the current version of `filename`.
+    """
+    st = os.stat(filename)
+    return os.path.join(cache_dir, "%s-%d-%d.npy" % (
+        hashlib.sha1(os.path.abspath(filename)).hexdigest()[:16],
+        int(st.st_mtime * 1e6), st.st_size
+    ))
+
+
+def load_skymodel(filename, cache_dir=None):
+    """
+    As read_skymodel(), but memoized both in memory and on disk.
+
+    The on-disk cache is stored in `cache_dir` (by default CACHE_DIRNAME
+    alongside the skymodel) and keyed by the skymodel's path, modification
+    time and size, so an edited skymodel is re-read. If the cache cannot be
+    written the skymodel is read as normal.
+    """
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIRNAME)
+    cache_name = cache_filename(filename, cache_dir)
+    with _memo_lock:
+        if cache_name in _memo:
+            return _memo[cache_name]
+
+    if os.path.exists(cache_name):
+        sources = np.load(cache_name)
+    else:
+        sources = read_skymodel(filename)
+        try:
+            try:
+                os.makedirs(cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, temp_name = mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, sources)
+            os.chmod(temp_name, 0644)
+            # Rename is atomic, so concurrent readers never see a partial file
+            os.rename(temp_name, cache_name)
+        except (IOError, OSError), e:
+            warnings.warn("Unable to cache %s: %s" % (filename, e))
+
+    with _memo_lock:
+        _memo[cache_name] = sources
+    return sources
@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import threading
+
+import metrics
+
+
+def sync_tree(source, destination):
+    """
+    Make the directory tree `destination` a copy of `source`, in the manner
+    of rsync: files which already exist in `destination` with the same size
+    and modification time are left alone, and files which don't exist in
+    `source` are removed.
+
+    Returns a tuple of (bytes copied, bytes skipped).
+    """
+    copied, skipped = 0, 0
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    shutil.copystat(source, destination)
+
+    source_entries = set(os.listdir(source))
+    for entry in set(os.listdir(destination)) - source_entries:
+        path = os.path.join(destination, entry)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    for entry in sorted(source_entries):
+        src = os.path.join(source, entry)
+        dst = os.path.join(destination, entry)
+        if os.path.isdir(src) and not os.path.islink(src):
+            if os.path.exists(dst) and not os.path.isdir(dst):
+                os.unlink(dst)
+            sub_copied, sub_skipped = sync_tree(src, dst)
+            copied += sub_copied
+            skipped += sub_skipped
+            continue
+        src_stat = os.stat(src)
+        if os.path.isfile(dst):
+            dst_stat = os.stat(dst)
+            if (
+                dst_stat.st_size == src_stat.st_size and
+                int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+            ):
+                skipped += src_stat.st_size
+                continue
+        elif os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copy2(src, dst)
+        copied += src_stat.st_size
+    return copied, skipped
+
+
+class Throughput(object):
+    """
+    Thread-safe accounting of the data transferred by each stage.
+
+    The rate reported for a stage is the total number of bytes it copied
+    divided by the wall clock time between the start of its first transfer
+    and the end of its last, so it reflects the aggregate rate of parallel
+    transfers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, copied, skipped, start, end):
+        with self.lock:
+            total = self.stages.setdefault(stage, {
+                "copied": 0, "skipped": 0, "files": 0, "start": start, "end": end
+            })
+            total["copied"] += copied
+            total["skipped"] += skipped
+            total["files"] += 1
+            total["start"] = min(total["start"], start)
+            total["end"] = max(total["end"], end)
+
+    def report(self):
+        with self.lock:
+            for stage, total in sorted(self.stages.iteritems()):
+                elapsed = max(total["end"] - total["start"], 1e-6)
+                print "%s: copied %.1f MB (skipped %.1f MB) in %d transfers; %.1f MB/s" % (
+                    stage, total["copied"] / 1e6, total["skipped"] / 1e6,
+                    total["files"], total["copied"] / 1e6 / elapsed
+                )
+
+
+# Transfers made by utility.copy_to_work_area are accounted here.
+throughput = Throughput()
+
+
+def stage_tree(source, destination, stage="staging"):
+    """
+    As sync_tree(), but recording the transfer against `stage` in
+    `throughput`.
+    """
+    start = time.time()
+    copied, skipped = sync_tree(source, destination)
+    end = time.time()
+    throughput.add(stage, copied, skipped, start, end)
+    metrics.record_transfer(source, end - start, copied, skipped)
+    print "Staged %s to %s: %.1f MB copied, %.1f MB already present, %.1f MB/s" % (
+        source, destination, copied / 1e6, skipped / 1e6,
+        copied / 1e6 / max(end - start, 1e-6)
+    )
+    return copied, skipped
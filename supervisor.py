@@ -0,0 +1,287 @@
+import os
+import time
+import shutil
+import errno
+import signal
+import threading
+import subprocess
+from collections import deque
+from tempfile import mkdtemp
+
+import metrics
+
+# Seconds between checks on running processes
+POLL_INTERVAL = 0.5
+
+# Seconds between progress summaries
+PROGRESS_INTERVAL = 60
+
+# Seconds a process which has timed out is given to exit after SIGTERM,
+# before it is sent SIGKILL
+KILL_GRACE = 30
+
+# Lines of a failed process's log which are printed
+LOG_TAIL_LINES = 20
+
+
+class Child(object):
+    def __init__(self, process, tool, log, workdir, timeout):
+        self.process = process
+        self.tool = tool
+        self.log = log
+        self.workdir = workdir
+        self.start_time = time.time()
+        self.deadline = self.start_time + timeout if timeout else None
+        self.timed_out = False
+        self.killed_at = None
+        self.status = None
+        self.rusage = None
+        self.done = threading.Event()
+
+
+class Supervisor(object):
+    """
+    Start external processes and watch over them from a single thread.
+
+    Each process writes its output directly to a log file under `log_dir`,
+    one per task, in a directory for each stage; without a `log_dir` it
+    writes to our own stdout. A process which runs for longer than the
+    `timeouts` given for its tool is killed, together with any processes it
+    has started; a process which is killed (by a timeout or any other
+    signal) is retried up to the `retries` given for its tool. A summary of
+    the running processes is printed every `progress_interval` seconds.
+
+    If a `work_dir` is given, each process which isn't given a working
+    directory of its own is run in a new, empty, directory there, so that
+    tools which write files to their working directory (such as the
+    calibrate-stand-alone logs) can't collide. Afterwards, the files they
+    leave are moved alongside their log, and the directory is removed.
+    """
+    def __init__(self, log_dir=None, timeouts=None, retries=None, progress_interval=PROGRESS_INTERVAL, work_dir=None):
+        self.log_dir = log_dir
+        self.work_dir = work_dir
+        self.timeouts = timeouts or {}
+        self.retries = retries or {}
+        self.progress_interval = progress_interval
+        self.children = []
+        self.finished = 0
+        self.failed = 0
+        self.retried = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.last_progress = time.time()
+
+    def log_file(self):
+        """
+        Return the name of the log file for the calling task.
+        """
+        tags = metrics.current_tags()
+        directory = os.path.join(self.log_dir, tags.get("stage", "other"))
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.path.join(
+            directory, tags.get("task", "process").replace(" ", "_") + ".log"
+        )
+
+    def run(self, args, tool, env=None, cwd=None):
+        """
+        Run `args`, retrying if it is killed, and return its exit status (as
+        subprocess.Popen.returncode) and resource usage.
+        """
+        attempt = 0
+        while True:
+            child = self._start(args, tool, env, cwd)
+            child.done.wait()
+            if child.workdir:
+                self._collect(child)
+            if child.status and child.log:
+                self._print_tail(child)
+            transient = child.timed_out or child.status < 0
+            if not transient or attempt >= self.retries.get(tool, 0):
+                return child.status, child.rusage
+            attempt += 1
+            with self.condition:
+                self.retried += 1
+            print "Retrying %s (%s): attempt %d" % (
+                tool, "timed out" if child.timed_out else "killed", attempt + 1
+            )
+            metrics.recorder.record("retry", tool, attempt=attempt, timed_out=child.timed_out)
+
+    def _start(self, args, tool, env, cwd):
+        log, workdir = None, None
+        if self.work_dir and not cwd:
+            cwd = workdir = mkdtemp(dir=self.work_dir, prefix=tool + ".")
+        try:
+            if self.log_dir:
+                log = self.log_file()
+                print "Executing: %s (log: %s)" % (" ".join(args), log)
+                with open(log, "a") as f:
+                    f.write("=== %s: %s\n" % (time.ctime(), " ".join(args)))
+                    f.flush()
+                    process = subprocess.Popen(
+                        args, env=env, cwd=cwd, stdout=f, stderr=subprocess.STDOUT,
+                        preexec_fn=os.setsid
+                    )
+            else:
+                print "Executing: " + " ".join(args)
+                process = subprocess.Popen(args, env=env, cwd=cwd, preexec_fn=os.setsid)
+        except:
+            if workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        child = Child(process, tool, log, workdir, self.timeouts.get(tool))
+        with self.condition:
+            self.children.append(child)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._watch)
+                self.thread.daemon = True
+                self.thread.start()
+        return child
+
+    def _collect(self, child):
+        # Move the files left in the working directory of `child` alongside
+        # its log, named after it, then remove the directory.
+        if child.log:
+            prefix = os.path.splitext(child.log)[0]
+            for filename in sorted(os.listdir(child.workdir)):
+                source = os.path.join(child.workdir, filename)
+                if not os.path.isfile(source):
+                    continue
+                destination = "%s.%s" % (prefix, filename)
+                suffix = 1
+                while os.path.exists(destination):
+                    destination = "%s.%s.%d" % (prefix, filename, suffix)
+                    suffix += 1
+                shutil.move(source, destination)
+        shutil.rmtree(child.workdir, ignore_errors=True)
+
+    def _watch(self):
+        while True:
+            with self.condition:
+                children = list(self.children)
+            now = time.time()
+            reaped = []
+            for child in children:
+                if self._reap(child):
+                    reaped.append(child)
+                elif child.deadline and now > child.deadline and not child.timed_out:
+                    print "%s (pid %d) timed out after %d seconds" % (
+                        child.tool, child.process.pid, now - child.start_time
+                    )
+                    child.timed_out = True
+                    child.killed_at = now
+                    self._signal(child, signal.SIGTERM)
+                elif child.killed_at and now > child.killed_at + KILL_GRACE:
+                    self._signal(child, signal.SIGKILL)
+            with self.condition:
+                idle = not self.children
+                if idle:
+                    # Started again by the next process.
+                    self.thread = None
+            # Only wake the waiting threads once we're done with our state,
+            # so that we're not still running when the last of them exits.
+            for child in reaped:
+                child.done.set()
+            if idle:
+                return
+            if now > self.last_progress + self.progress_interval:
+                self.last_progress = now
+                self.report()
+            time.sleep(POLL_INTERVAL)
+
+    def _reap(self, child):
+        try:
+            pid, status, rusage = os.wait4(child.process.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return False
+            raise
+        if not pid:
+            return False
+        if os.WIFSIGNALED(status):
+            child.process.returncode = -os.WTERMSIG(status)
+        else:
+            child.process.returncode = os.WEXITSTATUS(status)
+        child.status, child.rusage = child.process.returncode, rusage
+        if child.timed_out:
+            # Anything the process started which outlived it, so that a
+            # retry doesn't run alongside it.
+            self._signal(child, signal.SIGKILL)
+        with self.condition:
+            self.children.remove(child)
+            self.finished += 1
+            if child.status:
+                self.failed += 1
+        return True
+
+    def _signal(self, child, signum):
+        # Each process leads its own process group (see _start()), which is
+        # signalled as a whole, so that a timeout also reaches the processes
+        # started by wrapper scripts such as calibrate-stand-alone.
+        try:
+            os.killpg(child.process.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _print_tail(self, child):
+        with open(child.log, "r") as f:
+            tail = deque(f, LOG_TAIL_LINES)
+        print "%s exited with status %d; end of %s:" % (child.tool, child.status, child.log)
+        print "".join(tail).rstrip()
+
+    def report(self):
+        with self.condition:
+            now = time.time()
+            running = {}
+            for child in self.children:
+                count, longest = running.get(child.tool, (0, 0))
+                running[child.tool] = (count + 1, max(longest, now - child.start_time))
+            print "Processes: %d running%s; %d finished, %d failed, %d retried" % (
+                len(self.children),
+                "".join(
+                    ", %s x%d (longest %ds)" % (tool, count, longest)
+                    for tool, (count, longest) in sorted(running.iteritems())
+                ),
+                self.finished, self.failed, self.retried
+            )
+
+
+def from_parset(parset, log_dir=None, work_dir=None):
+    """
+    Create a Supervisor configured by the supervisor.* keys in `parset`:
+
+    supervisor.log_dir
+        Directory for process logs; defaults to `log_dir`.
+    supervisor.work_dir
+        Directory in which each process gets its own working directory;
+        defaults to `work_dir`.
+    supervisor.progress_interval
+        Seconds between progress summaries.
+    supervisor.tool.<tool>.timeout
+        Seconds after which <tool> is killed (no limit if 0).
+    supervisor.tool.<tool>.retries
+        Number of times <tool> is retried if it is killed.
+    """
+    subset = parset.makeSubset("supervisor.", "")
+    settings = {}
+    for key in subset.keys():
+        if key.startswith("tool."):
+            tool, setting = key[len("tool."):].rsplit(".", 1)
+            settings.setdefault(setting, {})[tool] = subset.getInt(key)
+    return Supervisor(
+        log_dir=subset.getString("log_dir", "") or log_dir,
+        work_dir=subset.getString("work_dir", "") or work_dir,
+        timeouts=settings.get("timeout"),
+        retries=settings.get("retries"),
+        progress_interval=subset.getInt("progress_interval", PROGRESS_INTERVAL)
+    )
+
+
+# Every process started by utility.run_process is supervised by this
+# instance. Without configuration, processes write to our stdout and are
+# never timed out or retried.
+processes = Supervisor()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+# Synthetic work units, for benchmarking the pipeline without LOFAR data or
+# the LOFAR tools.
+#
+# Usage: ./synthetic.py <directory> [stations] [subbands] [timesteps] [beams]
+#
+# There must be at least two subbands, since they are split into two bands.
+#
+# Writes to <directory>:
+#
+# data/       A calibrator observation of one beam and a target observation
+#             of `beams` beams, each of `subbands` subbands (split into two
+#             bands), as MS-like casacore tables of `stations` stations and
+#             `timesteps` integrations, with the columns and subtables the
+#             pipeline reads.
+# skymodels/  A skymodel for the calibrator and for each target beam, in the
+#             same format as those in skymodels/.
+# bin/        Stub executables standing in for awimager, NDPPP,
+#             calibrate-stand-alone and the other tools the pipeline runs.
+#             Each sleeps for the time given in bin/runtimes.json, and
+#             writes outputs which the pipeline can read.
+# init.sh     An initscript which puts the stubs on the PATH.
+# unit.parset A parset for imaging-multibeam.py, based on the one in this
+#             repository, which processes the work unit into output/.
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import numpy as np
+import pyrap.tables as pt
+import pyrap.images as pi
+import lofar.parameterset
+
+from utility import make_directory
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CAL_OBSID = "L000001"
+TARGET_OBSID = "L000002"
+CALIBRATOR = "3C196"
+
+# Integration time [s], channels per subband and frequencies [Hz]
+INTERVAL = 10.
+CHANNELS = 4
+START_FREQUENCY = 120e6
+SUBBAND_WIDTH = 195312.5
+
+# Stations within CORE_RADIUS [m] of the centre, and the rest out to
+# REMOTE_RADIUS, so that the baseline limit removes some baselines.
+CORE_FRACTION = 0.5
+CORE_RADIUS = 2000.
+REMOTE_RADIUS = 60000.
+
+# The first station has this many times the amplitude of the others, so
+# that there is a bad station to find.
+BAD_STATION_GAIN = 5.
+
+# Sources per skymodel, scattered within SKYMODEL_RADIUS [deg] of the beam
+SOURCES = 200
+SKYMODEL_RADIUS = 5.
+
+# Seconds each stub executable sleeps, by default
+STUB_RUNTIMES = {
+    "awimager": 1.,
+    "NDPPP": 0.5,
+    "calibrate-stand-alone": 0.5,
+    "parmexportcal": 0.1,
+    "edit_parmdb.py": 0.1,
+    "addImagingInfo": 0.1,
+    "asciistats.py": 0.2,
+    "statsplot.py": 0.1,
+}
+
+TEMPLATE_STUB = """#!%(python)s
+import sys
+sys.path.insert(0, %(script_dir)r)
+import synthetic
+synthetic.stub(sys.argv)
+"""
+
+
+def station_names(stations):
+    n_core = int(stations * CORE_FRACTION)
+    return [
+        ("CS%03dHBA0" % (i,) if i < n_core else "RS%03dHBA" % (i,))
+        for i in range(stations)
+    ]
+
+
+def station_positions(stations, rng):
+    n_core = int(stations * CORE_FRACTION)
+    radius = np.where(
+        np.arange(stations) < n_core, CORE_RADIUS, REMOTE_RADIUS
+    ) * np.sqrt(rng.uniform(size=stations))
+    angle = rng.uniform(0, 2 * np.pi, size=stations)
+    return np.column_stack([
+        radius * np.cos(angle), radius * np.sin(angle), np.zeros(stations)
+    ])
+
+
+def make_subtable(ms, name, columns, nrow):
+    """
+    Create the subtable `name` of `ms`, with `columns` (a list of
+    (description, values) pairs) and `nrow` rows.
+    """
+    path = os.path.join(ms.name(), name)
+    table = pt.table(
+        path, pt.maketabdesc([desc for desc, values in columns]), nrow=nrow
+    )
+    for desc, values in columns:
+        for row, value in enumerate(values):
+            table.putcell(desc["name"], row, value)
+    table.close()
+    ms.putkeyword(name, "Table: %s" % (path,))
+
+
+def make_ms(msname, stations, timesteps, pointing, frequency, target, seed=0):
+    """
+    Write an MS-like table of `stations` stations (including
+    autocorrelations) and `timesteps` integrations observing `target` at
+    `pointing` ((ra, dec) in degrees) and `frequency` [Hz].
+    """
+    rng = np.random.RandomState(seed)
+    names = station_names(stations)
+    positions = station_positions(stations, np.random.RandomState(0))
+    antenna1, antenna2 = np.triu_indices(stations)
+    n_baselines = len(antenna1)
+    nrow = n_baselines * timesteps
+    antenna1 = np.tile(antenna1, timesteps).astype(np.int32)
+    antenna2 = np.tile(antenna2, timesteps).astype(np.int32)
+    times = np.repeat(4.8e9 + INTERVAL * np.arange(timesteps), n_baselines)
+
+    # Baselines rotate with the hour angle.
+    baselines = positions[antenna2] - positions[antenna1]
+    hour_angle = 2 * np.pi * (times - times[0]) / 86400.
+    dec = math.radians(pointing[1])
+    uvw = np.column_stack([
+        baselines[:, 0] * np.cos(hour_angle) - baselines[:, 1] * np.sin(hour_angle),
+        (baselines[:, 0] * np.sin(hour_angle) + baselines[:, 1] * np.cos(hour_angle)) * np.sin(dec),
+        np.zeros(nrow)
+    ])
+
+    gain = np.ones(stations)
+    gain[0] = BAD_STATION_GAIN
+    shape = (nrow, CHANNELS, 4)
+    data = (rng.normal(size=shape) + 1j * rng.normal(size=shape)).astype(np.complex64)
+    data[..., [0, 3]] += 1.
+    data *= (gain[antenna1] * gain[antenna2])[:, np.newaxis, np.newaxis]
+
+    desc = pt.maketabdesc([
+        pt.makescacoldesc("TIME", 0.),
+        pt.makescacoldesc("ANTENNA1", 0),
+        pt.makescacoldesc("ANTENNA2", 0),
+        pt.makearrcoldesc("UVW", 0., shape=[3]),
+        pt.makearrcoldesc("DATA", 0j, shape=[CHANNELS, 4], valuetype="complex"),
+        pt.makearrcoldesc("FLAG", False, shape=[CHANNELS, 4]),
+    ])
+    ms = pt.table(msname, desc, nrow=nrow)
+    ms.putcol("TIME", times)
+    ms.putcol("ANTENNA1", antenna1)
+    ms.putcol("ANTENNA2", antenna2)
+    ms.putcol("UVW", uvw)
+    ms.putcol("DATA", data)
+    ms.putcol("FLAG", np.zeros(shape, dtype=bool))
+
+    direction = np.radians(pointing).reshape(1, 1, 2)
+    make_subtable(ms, "ANTENNA", [
+        (pt.makescacoldesc("NAME", ""), names),
+        (pt.makearrcoldesc("POSITION", 0., shape=[3]), positions),
+    ], stations)
+    make_subtable(ms, "FIELD", [
+        (pt.makescacoldesc("NAME", ""), [target]),
+        (pt.makearrcoldesc("REFERENCE_DIR", 0., shape=[1, 2]), direction),
+        (pt.makearrcoldesc("PHASE_DIR", 0., shape=[1, 2]), direction),
+    ], 1)
+    channels = frequency + SUBBAND_WIDTH * (np.arange(CHANNELS) - CHANNELS / 2.) / CHANNELS
+    make_subtable(ms, "SPECTRAL_WINDOW", [
+        (pt.makescacoldesc("REF_FREQUENCY", 0.), [frequency]),
+        (pt.makescacoldesc("NUM_CHAN", 0), [CHANNELS]),
+        (pt.makescacoldesc("MEAS_FREQ_REF", 0), [5]),
+        (pt.makearrcoldesc("CHAN_FREQ", 0., shape=[CHANNELS]), [channels]),
+        (pt.makearrcoldesc("CHAN_WIDTH", 0., shape=[CHANNELS]), [np.repeat(SUBBAND_WIDTH / CHANNELS, CHANNELS)]),
+    ], 1)
+    make_subtable(ms, "OBSERVATION", [
+        (pt.makescacoldesc("TELESCOPE_NAME", ""), ["LOFAR"]),
+        (pt.makearrcoldesc("LOFAR_TARGET", "", ndim=1), [np.array([target])]),
+        (pt.makearrcoldesc("TIME_RANGE", 0., shape=[2]), [[times[0], times[-1] + INTERVAL]]),
+    ], 1)
+    ms.close()
+    return msname
+
+
+def format_angle(value, hours):
+    # Sexagesimal, as in the skymodels: hh:mm:ss.s or +dd.mm.ss.s
+    sign = "-" if value < 0 else "+"
+    value = abs(value) / 15. if hours else abs(value)
+    d = int(value)
+    m = int((value - d) * 60)
+    s = (value - d - m / 60.) * 3600
+    if hours:
+        return "%02d:%02d:%011.8f" % (d, m, s)
+    return "%s%02d.%02d.%011.8f" % (sign, d, m, s)
+
+
+def make_skymodel(filename, pointing, sources=SOURCES, seed=0):
+    """
+    Write a skymodel of `sources` point and Gaussian sources scattered around
+    `pointing` ((ra, dec) in degrees).
+    """
+    rng = np.random.RandomState(seed)
+    with open(filename, "w") as f:
+        f.write(
+            "# (Name, Type, Ra, Dec, I, Q, U, V, ReferenceFrequency='60e6', "
+            " SpectralIndex='[0.0]', MajorAxis, MinorAxis, Orientation) = format\n\n"
+        )
+        for i in range(sources):
+            radius = SKYMODEL_RADIUS * math.sqrt(rng.uniform())
+            angle = rng.uniform(0, 2 * math.pi)
+            dec = pointing[1] + radius * math.sin(angle)
+            ra = (pointing[0] + radius * math.cos(angle) / math.cos(math.radians(dec))) % 360.
+            flux = rng.pareto(1.5) + 0.1
+            if rng.uniform() < 0.3:
+                major, minor = sorted(rng.uniform(10, 200, size=2), reverse=True)
+                shape = "GAUSSIAN", ", %.1f, %.1f, %.1f" % (major, minor, rng.uniform(0, 180))
+            else:
+                shape = "POINT", ""
+            f.write("S%04d, %s, %s, %s, %.4f, , , , , [-0.8]%s\n" % (
+                i, shape[0], format_angle(ra, True), format_angle(dec, False), flux, shape[1]
+            ))
+    return filename
+
+
+def parse_angle(value):
+    # An awimager cellsize, such as 25arcsec, in radians. This deliberately
+    # doesn't use utility.parse_cellsize(), so that the stub's images are
+    # made independently of utility.mask_template().
+    number, unit = re.match(r"([\d.eE+-]+)\s*(\w*)", value).groups()
+    return math.radians(float(number) / {
+        "arcsec": 3600., "arcmin": 60., "deg": 1., "": 3600.
+    }[unit])
+
+
+def make_image(image_name, ms, npix, cellsize, stokes, noise=1e-3):
+    """
+    Write a casacore image of `npix` square pixels of `cellsize` (in
+    awimager's format), with a plane for each of the Stokes parameters
+    `stokes`, centred on the pointing of `ms`, and filled with noise.
+    """
+    shape = (1, len(stokes), npix, npix)
+    # Take the default coordinate system for this shape, and point it.
+    coordsys = pi.image(image_name, shape=shape).coordinates().dict()
+    ra, dec = pt.table("%s::FIELD" % (ms,)).getcol("REFERENCE_DIR")[0][0]
+    cell = parse_angle(cellsize)
+    coordsys["direction0"].update({
+        "crval": [ra, dec],
+        "cdelt": [-cell, cell],
+        "crpix": [npix / 2., npix / 2.],
+        "units": ["rad", "rad"],
+        "projection": "SIN",
+    })
+    image = pi.image(image_name, shape=shape, coordsys=coordsys, overwrite=True)
+    image.putdata(
+        np.random.normal(scale=noise, size=shape).astype(np.float32)
+    )
+    return image_name
+
+
+def read_parset(filename):
+    """
+    Read the keys of a parset as strings, without lofar.parameterset, since
+    the stubs may be run with a bare environment.
+    """
+    keys = {}
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0]
+            if "=" in line:
+                key, value = line.split("=", 1)
+                keys[key.strip()] = value.strip()
+    return keys
+
+
+def stub(argv):
+    """
+    Entry point of the stub executables: behave as the tool named by
+    argv[0], as far as the pipeline can tell.
+    """
+    tool = os.path.basename(argv[0])
+    with open(os.path.join(os.path.dirname(argv[0]), "runtimes.json"), "r") as f:
+        time.sleep(json.load(f).get(tool, 0))
+    print "%s stub: %s" % (tool, " ".join(argv[1:]))
+    args = [arg for arg in argv[1:] if "=" not in arg]
+    if tool == "awimager":
+        if len(argv) == 2:
+            keys = read_parset(argv[1])
+        else:
+            keys = dict(arg.split("=", 1) for arg in argv[1:])
+        make_image(keys["image"], keys["ms"], int(float(keys.get("npix", 256))),
+            keys.get("cellsize", "25arcsec"), keys.get("stokes", "I")
+        )
+        if keys.get("operation", "image") != "empty":
+            for suffix in (".restored", ".restored.corr"):
+                shutil.copytree(keys["image"], keys["image"] + suffix)
+    elif tool == "NDPPP":
+        # The first input stands in for the combination.
+        keys = read_parset(args[0])
+        inputs = keys["msin"].strip("[]").replace("'", "").split(",")
+        pt.table(inputs[0].strip()).copy(keys["msout"], deep=True)
+    elif tool == "calibrate-stand-alone":
+        positional = [arg for arg in args if not arg.startswith("--")]
+        if "--parmdb" in args:
+            positional.remove(args[args.index("--parmdb") + 1])
+        ms = positional[0]
+        if "--replace-parmdb" in args:
+            instrument = os.path.join(ms, "instrument")
+            shutil.rmtree(instrument, ignore_errors=True)
+            os.mkdir(instrument)
+            with open(os.path.join(instrument, "table.dat"), "w") as f:
+                f.write("synthetic solution\n")
+        with open("calibrate-stand-alone_%d.log" % (os.getpid(),), "w") as f:
+            f.write("%s\n" % (" ".join(argv),))
+    elif tool == "parmexportcal":
+        keys = dict(arg.split("=", 1) for arg in argv[1:])
+        os.mkdir(keys["out"])
+    elif tool == "asciistats.py":
+        # The stations, for statsplot.py to report the first (whose gain is
+        # BAD_STATION_GAIN) as bad.
+        ms, statsdir = args[args.index("-i") + 1], args[args.index("-r") + 1]
+        names = pt.table("%s::ANTENNA" % (ms,)).getcol("NAME")
+        with open(os.path.join(statsdir, os.path.basename(ms) + ".stats"), "w") as f:
+            f.write("".join("%s\n" % (name,) for name in names))
+    elif tool == "statsplot.py":
+        with open(args[args.index("-i") + 1], "r") as f:
+            names = f.read().split()
+        with open(args[args.index("-o") + 1] + ".tab", "w") as f:
+            f.write("# index station bad\n")
+            for i, name in enumerate(names):
+                f.write("%d %s %s\n" % (i, name, i == 0))
+
+
+def make_stubs(bin_dir, runtimes=None):
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, "runtimes.json"), "w") as f:
+        json.dump(dict(STUB_RUNTIMES, **(runtimes or {})), f, indent=4, sort_keys=True)
+    for tool in STUB_RUNTIMES:
+        filename = os.path.join(bin_dir, tool)
+        with open(filename, "w") as f:
+            f.write(TEMPLATE_STUB % {
+                "python": sys.executable, "script_dir": SCRIPT_DIR
+            })
+        os.chmod(filename, 0755)
+
+
+def make_work_unit(directory, stations=24, subbands=4, timesteps=30, beams=2, runtimes=None):
+    """
+    Write a synthetic work unit to `directory` (see above). Returns a dict
+    of the names of its parset, initscript, stub directory, calibrator and
+    target MSs and target skymodels.
+    """
+    data_dir = os.path.join(directory, "data")
+    skymodel_dir = os.path.join(directory, "skymodels")
+    bin_dir = os.path.join(directory, "bin")
+    make_directory(skymodel_dir)
+    make_stubs(bin_dir, runtimes)
+    initscript = os.path.join(directory, "init.sh")
+    with open(initscript, "w") as f:
+        f.write("export PATH=%s:$PATH\n" % (bin_dir,))
+
+    unit = {
+        "initscript": initscript, "bin": bin_dir,
+        "cal": [], "target": [], "skymodels": []
+    }
+    make_skymodel(
+        os.path.join(skymodel_dir, "%s.skymodel" % (CALIBRATOR.lower(),)), (123.4, 48.2)
+    )
+    observations = [(CAL_OBSID, 0, (123.4, 48.2), CALIBRATOR)] + [
+        (TARGET_OBSID, beam, (10. * beam, 50.), "RSM") for beam in range(beams)
+    ]
+    for obsid, beam, pointing, target in observations:
+        make_directory(os.path.join(data_dir, obsid))
+        if obsid == TARGET_OBSID:
+            unit["skymodels"].append(make_skymodel(
+                os.path.join(skymodel_dir, "%.2f_%.2f.skymodel" % pointing),
+                pointing, seed=beam
+            ))
+        for sb in range(subbands):
+            unit["cal" if obsid == CAL_OBSID else "target"].append(make_ms(
+                os.path.join(data_dir, obsid, "%s_SAP00%d_SB%03d_uv.MS.dppp" % (
+                    obsid, beam, beam * subbands + sb
+                )),
+                stations, timesteps, pointing,
+                START_FREQUENCY + SUBBAND_WIDTH * sb, target,
+                seed=beam * subbands + sb
+            ))
+
+    for name in ("cal", "target"):
+        with open(os.path.join(directory, name + "_ms_list"), "w") as f:
+            f.write("".join("%s\n" % (ms,) for ms in unit[name]))
+    parset = lofar.parameterset.parameterset(
+        os.path.join(SCRIPT_DIR, "imaging-multibeam.parset")
+    )
+    for key, value in [
+        ("cal_ms_list", os.path.join(directory, "cal_ms_list")),
+        ("target_ms_list", os.path.join(directory, "target_ms_list")),
+        ("cal_obsid", CAL_OBSID),
+        ("target_obsid", TARGET_OBSID),
+        ("n_beams", str(beams)),
+        ("band_size", str([subbands - subbands // 2, subbands // 2])),
+        ("output_dir", os.path.join(directory, "output")),
+        ("skymodel_dir", skymodel_dir),
+        ("pdbclip.executable", os.path.join(bin_dir, "edit_parmdb.py")),
+        ("awimager.initscript", initscript),
+    ]:
+        parset.replace(key, value)
+    unit["parset"] = os.path.join(directory, "unit.parset")
+    parset.writeFile(unit["parset"])
+    return unit
+
+
+if __name__ == "__main__":
+    if 2 <= len(sys.argv) <= 6:
+        unit = make_work_unit(sys.argv[1], *[int(arg) for arg in sys.argv[2:]])
+        print "Parset: %s" % (unit["parset"],)
+        print "Run with PATH=%s:$PATH" % (unit["bin"],)
+    else:
+        print "Usage: %s <directory> [stations] [subbands] [timesteps] [beams]" % (sys.argv[0],)
+        sys.exit(1)
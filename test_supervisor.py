@@ -0,0 +1,52 @@
+import os
+import shutil
+import signal
+import unittest
+from tempfile import mkdtemp
+
+import supervisor
+
+WRAPPER = """#!/bin/sh
+sleep 600 >/dev/null 2>&1 &
+echo $! > %s
+wait
+"""
+
+
+def is_running(pid):
+    # A zombie has exited, although it may not have been reaped yet.
+    try:
+        with open("/proc/%d/stat" % (pid,), "r") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except IOError:
+        return False
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_timeout_kills_grandchildren(self):
+        pid_file = os.path.join(self.directory, "grandchild.pid")
+        wrapper = os.path.join(self.directory, "wrapper")
+        with open(wrapper, "w") as f:
+            f.write(WRAPPER % (pid_file,))
+        os.chmod(wrapper, 0755)
+
+        processes = supervisor.Supervisor(timeouts={"wrapper": 1})
+        status, rusage = processes.run([wrapper], "wrapper")
+        self.assertEqual(status, -signal.SIGTERM)
+
+        with open(pid_file, "r") as f:
+            grandchild = int(f.read())
+        running = is_running(grandchild)
+        if running:
+            os.kill(grandchild, signal.SIGKILL)
+        self.assertFalse(running)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,32 @@
 import re
 import os
+import math
 import time
 import errno
+import shutil
 import warnings
+import threading
 import subprocess
+import numpy
 import lofar.parameterset
 from glob import glob
 from contextlib import contextmanager
 from tempfile import mkstemp, mkdtemp
-from shutil import copytree, rmtree
 from pyrap.tables import table
+import pyrap.images as pi
+from msss_mask import fill_mask
+from imagestats import box_noise
+from imagestats import RunningStats
+from imagestats import MAD_TO_SIGMA
+from sourcelist import load_skymodel
+from staging import stage_tree
+import metrics
+import resources
+import supervisor
+
+
+# Visibility data columns which strip_stations can leave out of its output
+DATA_COLUMNS = ["DATA", "MODEL_DATA", "CORRECTED_DATA"]
 
 
 def read_ms_list(filename):
@@ -47,7 +64,8 @@ def get_file_list(root_dir, obsid, beam):
 def time_code(name):
     start_time = time.time()
     try:
-        yield
+        with metrics.measure(name):
+            yield
     finally:
         print "%s took %f seconds" % (name, time.time() - start_time)
 
@@ -55,6 +73,7 @@ def time_code(name):
 def get_parset_subset(parset, prefix, scratchdir):
     subset = parset.makeSubset(prefix + ".", "")
     fd, parset_name = mkstemp(dir=scratchdir)
+    os.close(fd)
     subset.writeFile(parset_name)
     return parset_name
 
@@ -86,13 +105,31 @@ def make_directory(path):
             raise
 
 
-def copy_to_work_area(input_file_list, work_area):
+def group_name(beam, band):
+    return "SAP00%d_band%d" % (beam, band)
+
+
+def group_names(parset):
+    """
+    Names of the band groups in the work unit described by `parset`.
+    """
+    return [
+        group_name(beam, band)
+        for beam in range(parset.getInt("n_beams"))
+        for band in range(len(parset.getIntVector("band_size")))
+    ]
+
+
+def copy_to_work_area(input_file_list, work_area, stage="staging"):
+    """
+    Copy each MS in `input_file_list` into `work_area`, skipping any files
+    which are already there with the same size and modification time.
+    Returns the list of copies.
+    """
     outputs = []
     for ms_name in input_file_list:
         output_name = os.path.join(work_area, os.path.basename(ms_name))
-        if os.path.exists(output_name):
-            rmtree(output_name)
-        copytree(ms_name, output_name)
+        stage_tree(ms_name, output_name, stage)
         outputs.append(output_name)
     return outputs
 
@@ -105,26 +142,63 @@ def run_process(executable, *args, **kwargs):
         env = read_initscript(kwargs['initscript'])
         if "module" in env:
             del env['module']
-    print "Executing: " + " ".join(args)
-    subprocess.check_call(args, env=env)
+    tool = os.path.basename(executable)
+    with resources.manager.reserve(tool) as cpus:
+        if resources.manager.pinned(tool):
+            # Bind the process, and any OpenMP threads it starts, to the
+            # CPUs it has been allotted.
+            env = dict(env or os.environ)
+            env["OMP_NUM_THREADS"] = str(resources.manager.footprint(tool)[0])
+            args = ["taskset", "-c", ",".join(str(cpu) for cpu in cpus)] + args
+        start_time = time.time()
+        status, rusage = supervisor.processes.run(
+            args, tool, env=env, cwd=kwargs.get("cwd")
+        )
+    metrics.record_process(executable, time.time() - start_time, rusage, status)
+    # ru_maxrss is in kB on Linux
+    resources.manager.record(tool, rusage.ru_maxrss / 1024)
+    if status:
+        raise subprocess.CalledProcessError(status, args)
+
+
+# Environments read from initscripts, keyed by (path, mtime, size).
+_initscript_cache = {}
+_initscript_lock = threading.Lock()
+
+
+def source_initscript(filename, shell="/bin/sh"):
+    """
+    Return the environment produced by sourcing `filename`.
+    """
+    print "Reading environment from %s" % (filename,)
+    p = subprocess.Popen(
+        ['. %s ; env' % (filename,)],
+        shell=True,
+        executable=shell,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+    )
+    so, se = p.communicate()
+    environment = [x.split('=', 1) for x in so.strip().split('\n')]
+    environment = filter(lambda x: len(x) == 2, environment)
+    return dict(environment)
 
 
 def read_initscript(filename, shell="/bin/sh"):
+    """
+    As source_initscript(), but the script is only sourced again if it has
+    changed since it was last read by this process. Returns a copy, which
+    the caller is free to modify.
+    """
     if not os.path.exists(filename):
         warnings.warn("Initialization script %s not found" % (filename,))
         return {}
-    else:
-        print "Reading environment from %s" % (filename,)
-        p = subprocess.Popen(
-            ['. %s ; env' % (filename,)],
-            shell=True,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-        )
-        so, se = p.communicate()
-        environment = [x.split('=', 1) for x in so.strip().split('\n')]
-        environment = filter(lambda x: len(x) == 2, environment)
-        return dict(environment)
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_mtime, st.st_size, shell)
+    with _initscript_lock:
+        if key not in _initscript_cache:
+            _initscript_cache[key] = source_initscript(filename, shell)
+        return dict(_initscript_cache[key])
 
 
 def run_awimager(parset_filename, parset_keys, initscript=None):
@@ -139,9 +213,9 @@ def run_ndppp(parset_filename, parset_keys, initscript=None):
     return parset_keys["msout"]
 
 
-def run_calibrate_standalone(parset_filename, input_ms, skymodel, replace_parmdb=False, replace_sourcedb=False, initscript=None):
+def run_calibrate_standalone(parset_filename, input_ms, skymodel, replace_parmdb=False, replace_sourcedb=False, initscript=None, cwd=None):
     args = ["calibrate-stand-alone", input_ms, parset_filename, skymodel]
-    kwargs = {}
+    kwargs = {"cwd": cwd}
     if initscript:
         kwargs["initscript"] = initscript
     if replace_parmdb:
@@ -152,37 +226,164 @@ def run_calibrate_standalone(parset_filename, input_ms, skymodel, replace_parmdb
     return input_ms
 
 
-def clear_calibrate_stand_alone_logs(directory=None):
-    # calibrate-stand-alone will create a log file according to the pattern
-    # calibrate-stand-alone_${PID}.log in the current working dir. If that
-    # file already exists, it will die. We rename old log files to ensure they
-    # can't cause it to break.
-    if not directory:
-        directory = os.getcwd()
-    for logfile in glob(os.path.join(directory, "calibrate-stand-alone*log")):
-        os.rename(logfile, logfile + ".old")
-
-
 def find_bad_stations(msname, scratchdir, initscript=None):
     # Using scripts developed by Martinez & Pandey
     statsdir = os.path.join(mkdtemp(dir=scratchdir))
-    run_process("asciistats.py", "-i", msname, "-r", statsdir, initscript=initscript)
-    statsfile = os.path.join(statsdir, os.path.basename(msname) + ".stats")
-    output_basename = os.path.join(statsdir, "stats")
-    run_process("statsplot.py", "-i", statsfile, "-o", output_basename, initscript=initscript)
-    bad_stations = []
-    with open(output_basename + ".tab", "r") as f:
-        for line in f:
-            if line.strip()[0] == "#": continue
-            if line.split()[-1] == "True":
-                bad_stations.append(line.split()[1])
+    try:
+        run_process("asciistats.py", "-i", msname, "-r", statsdir, initscript=initscript)
+        statsfile = os.path.join(statsdir, os.path.basename(msname) + ".stats")
+        output_basename = os.path.join(statsdir, "stats")
+        run_process("statsplot.py", "-i", statsfile, "-o", output_basename, initscript=initscript)
+        bad_stations = []
+        with open(output_basename + ".tab", "r") as f:
+            for line in f:
+                if line.strip()[0] == "#": continue
+                if line.split()[-1] == "True":
+                    bad_stations.append(line.split()[1])
+    finally:
+        shutil.rmtree(statsdir, ignore_errors=True)
+    return bad_stations
+
+
+def station_amplitudes(msname, column="DATA", chunk_rows=10000):
+    """
+    Mean amplitude of the unflagged parallel-hand visibilities on the
+    cross-correlation baselines of each station in `msname`, reading
+    `chunk_rows` rows at a time. Returns a dict mapping station names to
+    their mean amplitudes, which are NaN for stations with no unflagged data.
+    """
+    names = table("%s::ANTENNA" % (msname,)).getcol("NAME")
+    total = numpy.zeros(len(names))
+    count = numpy.zeros(len(names))
+    t = table(msname)
+    for start in range(0, t.nrows(), chunk_rows):
+        nrow = min(chunk_rows, t.nrows() - start)
+        antenna1 = t.getcol("ANTENNA1", start, nrow)
+        antenna2 = t.getcol("ANTENNA2", start, nrow)
+        cross = antenna1 != antenna2
+        # XX and YY are the first and last correlations.
+        data = t.getcol(column, start, nrow)[cross][..., [0, -1]]
+        valid = ~t.getcol("FLAG", start, nrow)[cross][..., [0, -1]]
+        valid &= numpy.isfinite(data)
+        amplitude = numpy.where(valid, numpy.abs(data), 0.)
+        # Totals for each baseline are credited to both of its stations.
+        sums = amplitude.reshape(len(amplitude), -1).sum(axis=1)
+        counts = valid.reshape(len(valid), -1).sum(axis=1)
+        for antenna in (antenna1[cross], antenna2[cross]):
+            total += numpy.bincount(antenna, sums, minlength=len(names))
+            count += numpy.bincount(antenna, counts, minlength=len(names))
+    t.close()
+    with numpy.errstate(invalid="ignore"):
+        return dict(zip(names, total / count))
+
+
+def outlier_stations(amplitudes, threshold=5.):
+    """
+    Stations whose mean amplitude differs from the median over all stations
+    by more than `threshold` sigma, where sigma is estimated from the median
+    absolute deviation. Stations with no unflagged data are ignored.
+    """
+    values = numpy.array([value for value in amplitudes.values() if numpy.isfinite(value)])
+    if not values.size:
+        return []
+    median = numpy.median(values)
+    sigma = MAD_TO_SIGMA * numpy.median(numpy.abs(values - median))
+    return sorted(
+        name for name, value in amplitudes.iteritems()
+        if numpy.isfinite(value) and abs(value - median) > threshold * sigma
+    )
+
+
+def detect_bad_stations(msname, column="DATA", threshold=5.):
+    """
+    In-process equivalent of find_bad_stations(): read `msname` once and
+    return the names of the stations whose amplitudes are outliers.
+    """
+    amplitudes = station_amplitudes(msname, column)
+    bad_stations = outlier_stations(amplitudes, threshold)
+    for name in bad_stations:
+        print "Bad station in %s: %s (mean amplitude %g)" % (msname, name, amplitudes[name])
     return bad_stations
 
 
-def strip_stations(msin, msout, stationlist):
+class RowLayout(object):
+    """
+    The row layout (TIME, ANTENNA1 and ANTENNA2 of each row) shared by MSs
+    with the same time samples and baselines, such as the band groups of a
+    beam, together with the squared uv distance of each row.
+
+    The layout is taken from the first MS given to match(), which is the
+    only one whose UVW column is read; row selections on any other MS with
+    the same layout can then be made from the arrays held here.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time = None
+        self.antenna1 = None
+        self.antenna2 = None
+        self.uv_distance2 = None
+
+    def match(self, t):
+        """
+        Return the ANTENNA1 and ANTENNA2 columns of the table `t` if its rows
+        are laid out as this layout's, or None if they are not.
+        """
+        time = t.getcol("TIME")
+        antenna1, antenna2 = t.getcol("ANTENNA1"), t.getcol("ANTENNA2")
+        with self.lock:
+            if self.time is None:
+                uvw = t.getcol("UVW")
+                self.time, self.antenna1, self.antenna2 = time, antenna1, antenna2
+                self.uv_distance2 = numpy.sum(uvw[:, :2]**2, axis=1)
+                return antenna1, antenna2
+        if (
+            numpy.array_equal(time, self.time) and
+            numpy.array_equal(antenna1, self.antenna1) and
+            numpy.array_equal(antenna2, self.antenna2)
+        ):
+            return antenna1, antenna2
+        warnings.warn("Row layout of %s differs; not reusing selections" % (t.name(),))
+        return None
+
+
+def strip_stations(msin, msout, stationlist, data_columns=None, layout=None):
+    """
+    Write to `msout` a copy of `msin` without any baselines involving the
+    stations in `stationlist`.
+
+    If `data_columns` is given, only those visibility data columns (see
+    DATA_COLUMNS) are copied; all the other columns and the subtables are
+    always retained. Leaving out columns which are not needed for imaging
+    saves both time and space, since the data columns dominate the size of
+    the MS.
+
+    If `msin` matches the RowLayout `layout`, the rows are selected directly
+    and their numbers in `msin` are returned, for limit_baselines();
+    otherwise None is returned.
+    """
     t = table(msin)
+    columns = ""
+    if data_columns is not None:
+        columns = ",".join(
+            column for column in t.colnames()
+            if column not in DATA_COLUMNS or column in data_columns
+        )
+    antennas = layout.match(t) if layout else None
+    if antennas:
+        names = table("%s::ANTENNA" % (msin,)).getcol("NAME")
+        bad = numpy.flatnonzero(numpy.in1d(names, stationlist))
+        rows = numpy.flatnonzero(
+            ~(numpy.in1d(antennas[0], bad) | numpy.in1d(antennas[1], bad))
+        )
+        output = t.selectrows(rows)
+        if columns:
+            output = output.query(columns=columns)
+        output.copy(msout, deep=True)
+        return rows
+
+    query = ""
     if stationlist:
-        output = t.query("""
+        query = """
             all(
                 [ANTENNA1, ANTENNA2] not in
                 [
@@ -190,20 +391,43 @@ def strip_stations(msin, msout, stationlist):
                 ]
             )
             """ % str(stationlist)
-        )
+    if query or columns:
+        output = t.query(query, columns=columns)
     else:
         output = t
-    # Is a deep copy really necessary here?
+    # The stripped MS is one of our output data products, so it must be a
+    # real copy rather than a reference to the scratch area.
     output.copy(msout, deep=True)
 
 
-def limit_baselines(msin, msout, maxbl):
+def limit_baselines(msin, msout, maxbl, layout=None, rows=None):
+    """
+    Write to `msout` a reference to the rows of `msin` with uv distances
+    shorter than `maxbl` metres.
+
+    If `msin` consists of the `rows` of the RowLayout `layout`, as returned
+    by strip_stations(), the uv distances are taken from the layout rather
+    than calculated from the UVW column.
+    """
     t = table(msin)
-    out = t.query("sumsqr(UVW[:2])<%.1e" % (maxbl**2,))
+    # As rounded in the TaQL query
+    limit = float("%.1e" % (maxbl**2,))
+    if (
+        layout and layout.uv_distance2 is not None and
+        rows is not None and t.nrows() == len(rows)
+    ):
+        out = t.selectrows(numpy.flatnonzero(layout.uv_distance2[rows] < limit))
+    else:
+        out = t.query("sumsqr(UVW[:2])<%.1e" % (maxbl**2,))
     out.copy(msout, deep=False)
 
 
-def estimate_noise(msin, parset_name, wmax, box_size, scratchdir, awim_init=None):
+def estimate_noise(msin, parset_name, wmax, box_size, scratchdir, awim_init=None, estimator="std"):
+    """
+    Make a dirty image of `msin` and return the noise in Stokes V in a box
+    of half-width `box_size` pixels at its centre, as calculated by the
+    imagestats `estimator`. Only that box is read from the image.
+    """
     noise_image = mkdtemp(dir=scratchdir)
 
     run_awimager(parset_name,
@@ -215,19 +439,153 @@ def estimate_noise(msin, parset_name, wmax, box_size, scratchdir, awim_init=None
         initscript=awim_init
     )
 
-    parset = lofar.parameterset.parameterset(parset_name)
-    npix = parset.getFloat("npix")
-    t = table(noise_image)
-    # Why is there a 3 in here? Are we calculating the noise in Stokes V?
-    # (this is lifted from Antonia, which is lifted from George, ...!)
-    noise = t.getcol('map')[0, 0, 3, npix/2-box_size:npix/2+box_size, npix/2-box_size:npix/2+box_size].std()
+    try:
+        return box_noise(noise_image, box_size, estimator, stokes="V")
+    finally:
+        # awimager also writes other products alongside the image.
+        for product in [noise_image] + glob(noise_image + ".*"):
+            shutil.rmtree(product, ignore_errors=True)
+
+
+def visibility_noise(msin, column="CORRECTED_DATA", chunk_rows=10000):
+    """
+    Estimate the noise in a naturally weighted Stokes V image of `msin`
+    from the scatter of its Stokes V visibilities, without imaging.
+
+    Stokes V is formed from the cross-hand correlations, (XY - YX) / 2. Its
+    real and imaginary parts share the same standard deviation, sigma, and
+    the image noise is sigma / sqrt(N), where N is the number of unflagged
+    cross-correlation visibilities. The table is read `chunk_rows` rows at a
+    time.
+    """
+    t = table(msin)
+    stats = RunningStats()
+    count = 0
+    for start in range(0, t.nrows(), chunk_rows):
+        nrow = min(chunk_rows, t.nrows() - start)
+        cross = t.getcol("ANTENNA1", start, nrow) != t.getcol("ANTENNA2", start, nrow)
+        data = t.getcol(column, start, nrow)[cross]
+        flag = t.getcol("FLAG", start, nrow)[cross]
+        valid = ~(flag[..., 1] | flag[..., 2])
+        stokes_v = (data[..., 1][valid] - data[..., 2][valid]) / 2.
+        stokes_v = stokes_v[numpy.isfinite(stokes_v)]
+        stats.add(numpy.concatenate([stokes_v.real, stokes_v.imag]))
+        count += stokes_v.size
     t.close()
-    return noise
+    if not count:
+        raise ValueError("No unflagged visibilities in %s" % (msin,))
+    return stats.std / numpy.sqrt(count)
+
+
+# Spectral reference frames, indexed by the MEAS_FREQ_REF of an MS
+FREQUENCY_FRAMES = [
+    "REST", "LSRK", "LSRD", "BARY", "GEO", "TOPO", "GALACTO", "LGROUP", "CMB"
+]
 
+# Largest difference between coordinate values which are considered equal
+COORDINATE_TOLERANCE = 1e-9
 
-def make_mask(msin, parset, skymodel, executable, scratchdir, awim_init=None):
+
+def parse_cellsize(cellsize):
+    """
+    Convert an awimager cellsize, such as 25arcsec, to radians.
+    """
+    number, unit = re.match(r"([\d.eE+-]+)\s*(\w*)", cellsize).groups()
+    return math.radians(float(number) / {
+        "arcsec": 3600., "arcmin": 60., "deg": 1., "rad": 180. / math.pi, "": 3600.
+    }[unit])
+
+
+def mask_template(image_name, msin, npix, cellsize, stokes):
+    """
+    Write an empty casacore image with the coordinates awimager gives an
+    image of `npix` square pixels of `cellsize` in the Stokes parameters
+    `stokes`: centred on the phase centre of `msin`, with a single channel
+    covering its band.
+    """
+    field = table("%s::FIELD" % (msin,))
+    ra, dec = field.getcol("PHASE_DIR")[0][0]
+    direction_frame = field.getcolkeywords("PHASE_DIR").get("MEASINFO", {}).get("Ref", "J2000")
+    field.close()
+    spw = table("%s::SPECTRAL_WINDOW" % (msin,))
+    frequencies = spw.getcol("CHAN_FREQ")[0]
+    widths = spw.getcol("CHAN_WIDTH")[0]
+    frequency_frame = FREQUENCY_FRAMES[spw.getcol("MEAS_FREQ_REF")[0]]
+    spw.close()
+    observation = table("%s::OBSERVATION" % (msin,))
+    start_time = observation.getcol("TIME_RANGE")[0][0]
+    telescope = observation.getcol("TELESCOPE_NAME")[0]
+    observation.close()
+
+    low = numpy.min(frequencies - widths / 2.)
+    high = numpy.max(frequencies + widths / 2.)
+    cell = parse_cellsize(cellsize)
+    shape = (1, len(stokes), npix, npix)
+    # Start from the default coordinate system for this shape.
+    coordsys = pi.image(image_name, shape=shape).coordinates().dict()
+    coordsys["direction0"].update({
+        "system": direction_frame,
+        "crval": [ra, dec],
+        "cdelt": [-cell, cell],
+        "crpix": [float(npix // 2), float(npix // 2)],
+        "units": ["rad", "rad"],
+        "projection": "SIN",
+        "projection_parameters": [0., 0.],
+    })
+    coordsys["stokes1"]["stokes"] = list(stokes)
+    coordsys["spectral2"].update({
+        "system": frequency_frame,
+        "restfreq": (low + high) / 2.,
+        "restfreqs": [(low + high) / 2.],
+    })
+    coordsys["spectral2"]["wcs"].update({
+        "crval": (low + high) / 2., "cdelt": high - low, "crpix": 0.
+    })
+    coordsys["telescope"] = telescope
+    coordsys["obsdate"] = {
+        "type": "epoch", "refer": "UTC",
+        "m0": {"value": start_time / 86400., "unit": "d"}
+    }
+    image = pi.image(image_name, shape=shape, coordsys=coordsys, overwrite=True)
+    image.putdata(numpy.zeros(shape, dtype=numpy.float32))
+    return image_name
+
+
+def coordinate_differences(first, second, tolerance=COORDINATE_TOLERANCE):
+    """
+    Compare the shapes and the direction, Stokes and spectral coordinates of
+    the images `first` and `second`. Returns a list of the differences.
+    """
+    def compare(name, a, b):
+        if isinstance(a, dict) and isinstance(b, dict):
+            return sum((
+                compare("%s.%s" % (name, key), a.get(key), b.get(key))
+                for key in sorted(set(a) | set(b))
+            ), [])
+        try:
+            same = numpy.allclose(a, b, rtol=0, atol=tolerance)
+        except (TypeError, ValueError):
+            same = numpy.array_equal(a, b)
+        return [] if same else ["%s: %s != %s" % (name, a, b)]
+
+    images = pi.image(first), pi.image(second)
+    differences = compare("shape", *[list(image.shape()) for image in images])
+    coordinates = [image.coordinates().dict() for image in images]
+    for name in ("direction0", "stokes1", "spectral2"):
+        differences.extend(compare(name, *[c.get(name) for c in coordinates]))
+    return differences
+
+
+def make_mask(msin, parset, skymodel, scratchdir, awim_init=None, template="awimager"):
+    """
+    Make a clean mask covering the sources in `skymodel`, with the geometry
+    of the image made of `msin` with the awimager `parset`.
+
+    The empty image to be filled is written by awimager if `template` is
+    awimager, or by mask_template() if it is native. If it is check, both are
+    made, and an error is raised unless their coordinates agree.
+    """
     mask_image = mkdtemp(dir=scratchdir)
-    mask_sourcedb = mkdtemp(dir=scratchdir)
     operation = "empty"
 
     awimager_parset = lofar.parameterset.parameterset(parset)
@@ -235,25 +593,28 @@ def make_mask(msin, parset, skymodel, executable, scratchdir, awim_init=None):
     npix = awimager_parset.getFloat("npix")
     stokes = awimager_parset.getString("stokes")
 
-    run_process(
-        "awimager",
-        "cellsize=%s" % (cellsize,),
-        "ms=%s" % (msin,),
-        "npix=%d" % (npix,),
-        "operation=%s" % (operation,),
-        "image=%s" % (mask_image,),
-        "stokes=%s" % (stokes,),
-        initscript=awim_init
-    )
-    run_process(
-        "makesourcedb",
-        "in=%s" % (skymodel,),
-        "out=%s" % (mask_sourcedb,),
-        "format=<"
-    )
-    run_process(
-        executable,
-        mask_image,
-        mask_sourcedb
-    )
+    if template in ("awimager", "check"):
+        run_process(
+            "awimager",
+            "cellsize=%s" % (cellsize,),
+            "ms=%s" % (msin,),
+            "npix=%d" % (npix,),
+            "operation=%s" % (operation,),
+            "image=%s" % (mask_image,),
+            "stokes=%s" % (stokes,),
+            initscript=awim_init
+        )
+    if template == "check":
+        native = mask_template(mask_image + ".native", msin, int(npix), cellsize, stokes)
+        differences = coordinate_differences(mask_image, native)
+        shutil.rmtree(native)
+        if differences:
+            raise ValueError(
+                "Mask template coordinates differ from awimager's: %s" % ("; ".join(differences),)
+            )
+    elif template == "native":
+        mask_template(mask_image, msin, int(npix), cellsize, stokes)
+    elif template != "awimager":
+        raise ValueError("Unknown mask template: %s" % (template,))
+    fill_mask(mask_image, load_skymodel(skymodel))
     return mask_image